@@ -6,8 +6,25 @@ import xml.etree.ElementTree as ET
 from ast import literal_eval
 import re
 import pickle
-from svector import SVector
-from tqdm.notebook import tqdm
+import os
+import hashlib
+import inspect
+import struct
+import zipfile
+from array import array
+import multiprocessing as mp
+import mmap
+import copy
+from collections import namedtuple
+from multiprocessing import shared_memory
+from contextlib import nullcontext
+from svector import SVector, distances_to_sections, _xyz_from_latlon_array
+from instrumentation import span, count, annotate, progress
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
 
 # Intensity calculation
 def intensity_europe(M, R):
@@ -31,6 +48,399 @@ def edge_to_SVectors(edge):
     lat1, long1 = edge['points']['point'][1]['Latitude'], edge['points']['point'][1]['Longitude']
     return SVector(lat0, long0), SVector(lat1, long1)
 
+EARTH_RADIUS = 6371
+
+def edges_to_sections(network):
+    # every consecutive point pair of every edge polyline, with the index of the edge it belongs to
+    edge_idx, src, dst = [], [], []
+    for idx, e in enumerate(network.edges):
+        points = [(p['Latitude'], p['Longitude']) for p in network.edges[e]['points']['point']]
+        for p0, p1 in zip(points[:-1], points[1:]):
+            edge_idx.append(idx)
+            src.append(p0)
+            dst.append(p1)
+    return np.array(edge_idx), np.array(src, dtype=float), np.array(dst, dtype=float)
+
+def get_distance_matrix(network, epicenters, chunk_size=4096):
+    # epicenters: (Long, Lat) pairs, result: [L,P] distances in km from every edge polyline
+    epicenters = np.asarray(epicenters, dtype=float)
+    edge_idx, src, dst = edges_to_sections(network)
+    section_distances = distances_to_sections(epicenters[:, 1], epicenters[:, 0], src[:, 0], src[:, 1], dst[:, 0], dst[:, 1], chunk_size)
+    D = np.full((network.number_of_edges(), len(epicenters)), np.inf)
+    np.minimum.at(D, edge_idx, section_distances)
+    return D * EARTH_RADIUS
+
+def check_distance_matrix(network, epicenters, n_epicenters=200, tolerance=1e-6, seed=0):
+    # The batched distances of get_distance_matrix against SVector.distance_to_section, section by section, on a random
+    # sample of the epicenters. Raises a ValueError above tolerance km, returns the largest difference in km.
+    epicenters = np.asarray(epicenters, dtype=float)
+    sample = np.random.default_rng(seed).choice(len(epicenters), min(n_epicenters, len(epicenters)), replace=False)
+    edge_idx, src, dst = edges_to_sections(network)
+    sections = [(SVector(*p0), SVector(*p1)) for p0, p1 in zip(src, dst)]
+    expected = np.full((network.number_of_edges(), len(sample)), np.inf)
+    for j, (lon, lat) in enumerate(epicenters[sample]):
+        point = SVector(lat, lon)
+        for idx, (p0, p1) in zip(edge_idx, sections):
+            expected[idx, j] = min(expected[idx, j], point.distance_to_section(p0, p1) * EARTH_RADIUS)
+    error = float(np.abs(get_distance_matrix(network, epicenters[sample]) - expected).max())
+    if error > tolerance:
+        raise ValueError(f'Batched distances differ from SVector.distance_to_section by {error:.3g} km (tolerance {tolerance:g} km)')
+    return error
+
+
+# Intensity matrix generation
+ATTENUATION_MODELS = {'europe': intensity_europe, 'usa': intensity_usa}
+
+def read_earthquake_probabilities(probability_file):
+    # epicenters as (Long, Lat) pairs, magnitudes, and the [P,M] probability matrix
+    df = pd.read_csv(probability_file)
+    epicenters = df[['Long', 'Lat']].to_numpy()
+    prob_matrix = df.drop(['Lat', 'Long'], axis=1)
+    magnitudes = prob_matrix.columns.astype(float).to_numpy()
+    return epicenters, magnitudes, prob_matrix.to_numpy()
+
+def build_intensity_matrix(network, epicenters, magnitudes, attenuation=intensity_europe, out=None, magnitude_chunk=8):
+    # [L,P,M] intensities, clipped below at 1.0, computed magnitude_chunk magnitudes at a time;
+    # out can be a memmap so the cube never has to fit in memory
+    D = get_distance_matrix(network, epicenters)[:, :, None]
+    if out is None:
+        out = np.empty((len(D), len(epicenters), len(magnitudes)))
+    for start in range(0, len(magnitudes), magnitude_chunk):
+        M = np.asarray(magnitudes[start:start + magnitude_chunk], dtype=float)
+        out[:, :, start:start + len(M)] = np.maximum(attenuation(M, D), 1.)
+    return out
+
+def intensity_cache_key(network_file, probability_file, attenuation='europe'):
+    h = hashlib.sha256()
+    for file in (network_file, probability_file):
+        with open(file, 'rb') as f:
+            h.update(f.read())
+    h.update(attenuation.encode())
+    h.update(inspect.getsource(ATTENUATION_MODELS[attenuation]).encode())
+    return h.hexdigest()[:16]
+
+# Quantized intensities: ceil(intensity) as uint8. A link fails when intensity > tolerance, and for an integer
+# tolerance t that is exactly ceil(intensity) > t, so the uint8 cube gives the same failures as the float64 one
+# with an eighth of the size. Only valid for integer tolerances (Hnull + spine_bonus*onspine + deltaH).
+def quantize_intensity_matrix(intensity_matrix, out=None):
+    if out is None:
+        out = np.empty(intensity_matrix.shape, dtype=np.uint8)
+    for l in range(intensity_matrix.shape[0]):
+        out[l] = np.clip(np.ceil(intensity_matrix[l]), 0, 255)
+    return out
+
+def convert_intensity_matrix(npy_file, out_file=None):
+    # Writes the uint8 version of a float .npy cube next to it (or to out_file), one link at a time
+    if out_file is None:
+        out_file = f'{os.path.splitext(npy_file)[0]}_u8.npy'
+    intensity = np.load(npy_file, mmap_mode='r')
+    tmp_file = f'{out_file}.{os.getpid()}.tmp'
+    out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=intensity.shape)
+    quantize_intensity_matrix(intensity, out)
+    out.flush()
+    del out
+    os.replace(tmp_file, out_file)
+    return out_file
+
+def get_intensity_matrix(network_file, probability_file, attenuation='europe', cache_dir='intensities', magnitude_chunk=8, mmap_mode=None, quantized=False):
+    # Loads the cube from cache_dir, building it first if the network, the grid or the attenuation model changed;
+    # quantized=True gives the uint8 cube, with mmap_mode='r' concurrent runs share its pages
+    network_name = os.path.splitext(os.path.basename(network_file))[0]
+    grid_name = os.path.splitext(os.path.basename(probability_file))[0]
+    key = intensity_cache_key(network_file, probability_file, attenuation)
+    path = os.path.join(cache_dir, f'{network_name}_{grid_name}_{attenuation}_{key}.npy')
+    quantized_path = f'{os.path.splitext(path)[0]}_u8.npy'
+    if quantized and os.path.exists(quantized_path):
+        return np.load(quantized_path, mmap_mode=mmap_mode)
+    if not os.path.exists(path):
+        with span('intensity_matrix', network=network_name, grid=grid_name, attenuation=attenuation):
+            os.makedirs(cache_dir, exist_ok=True)
+            g = nx.read_gml(network_file, label='id')
+            epicenters, magnitudes, _ = read_earthquake_probabilities(probability_file)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64, shape=(g.number_of_edges(), len(epicenters), len(magnitudes)))
+            build_intensity_matrix(g, epicenters, magnitudes, ATTENUATION_MODELS[attenuation], out, magnitude_chunk)
+            out.flush()
+            del out
+            os.replace(tmp_path, path)
+    if quantized:
+        with span('quantize_intensity_matrix', network=network_name, grid=grid_name, attenuation=attenuation):
+            quantized_path = convert_intensity_matrix(path, quantized_path)
+        return np.load(quantized_path, mmap_mode=mmap_mode)
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+# Spatial cutoff: the intensity decreases with the distance, so beyond the distance at which the largest magnitude
+# reaches the smallest tolerance in use, no magnitude fails a link. Only the (link, epicenter) pairs within that
+# radius are computed and stored, the others read as the clipped intensity 1.
+def cutoff_distance(attenuation, magnitude, tolerance, max_distance=20000.):
+    # Distance in km beyond which attenuation(magnitude, distance) <= tolerance, by bisection
+    if attenuation(magnitude, 0.) <= tolerance:
+        return 0.
+    if attenuation(magnitude, max_distance) > tolerance:
+        return max_distance
+    low, high = 0., max_distance
+    while high - low > 1e-6:
+        mid = (low + high) / 2
+        if attenuation(magnitude, mid) > tolerance:
+            low = mid
+        else:
+            high = mid
+    return high
+
+class EpicenterIndex:
+    # KD-tree over the epicenters as 3D unit vectors (a brute force chord test when scipy is missing). The epicenters
+    # within an arc distance of a section are inside the ball around the section midpoint with the half section added
+    # to the radius; the candidates of the ball are then checked with the exact distances of get_distance_matrix.
+    def __init__(self, epicenters):
+        # epicenters: (Long, Lat) pairs
+        self.epicenters = np.asarray(epicenters, dtype=float)
+        self.points = _xyz_from_latlon_array(self.epicenters[:, 1], self.epicenters[:, 0])
+        self.tree = cKDTree(self.points) if cKDTree is not None else None
+
+    def within_chord(self, center, chord):
+        if self.tree is not None:
+            return np.asarray(self.tree.query_ball_point(center, chord), dtype=np.int64)
+        return np.flatnonzero(((self.points - center) ** 2).sum(axis=1) <= chord ** 2)
+
+    def link_distances(self, network, radius):
+        # Per link the sorted indices of the epicenters within radius km of its polyline, and their distances
+        edge_idx, src, dst = edges_to_sections(network)
+        src_xyz, dst_xyz = _xyz_from_latlon_array(src[:, 0], src[:, 1]), _xyz_from_latlon_array(dst[:, 0], dst[:, 1])
+        half_arc = np.arccos(np.clip((src_xyz * dst_xyz).sum(axis=1), -1., 1.)) / 2
+        mid = src_xyz + dst_xyz
+        mid_norm = np.linalg.norm(mid, axis=1, keepdims=True)
+        mid = np.where(mid_norm > 1e-12, mid / np.maximum(mid_norm, 1e-12), src_xyz)
+        for l in range(network.number_of_edges()):
+            sections = np.flatnonzero(edge_idx == l)
+            candidates = []
+            for i in sections:
+                angle = radius / EARTH_RADIUS + half_arc[i]
+                chord = 2 * np.sin(min(angle, np.pi) / 2) + 1e-9
+                candidates.append(self.within_chord(mid[i], chord))
+            candidates = np.unique(np.concatenate(candidates)) if candidates else np.zeros(0, dtype=np.int64)
+            distances = distances_to_sections(self.epicenters[candidates, 1], self.epicenters[candidates, 0],
+                                              src[sections, 0], src[sections, 1], dst[sections, 0], dst[sections, 1]).min(axis=0) * EARTH_RADIUS \
+                if len(candidates) else np.zeros(0)
+            keep = distances <= radius
+            count('epicenter_candidates', len(candidates))
+            yield candidates[keep], distances[keep]
+
+class SparseIntensityMatrix:
+    # The [L,P,M] intensity cube with only the epicenters within the cutoff radius of every link stored, as CSR over
+    # the links: link l has the epicenters epicenters[offsets[l]:offsets[l+1]] with the [n,M] intensities
+    # values[offsets[l]:offsets[l+1]]. Every other (l,p,m) reads as fill and never exceeds tolerance.
+    # Indexing gives dense rows, so it can be passed in place of the cube as long as the tolerances are >= tolerance;
+    # CriticalMagnitudeIndex and get_failure_levels only visit the stored pairs.
+    def __init__(self, shape, offsets, epicenters, values, tolerance, fill=1):
+        self.shape = tuple(int(n) for n in shape)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.epicenters = np.asarray(epicenters, dtype=np.int64)
+        self.values = values
+        self.tolerance = tolerance
+        self.fill = fill
+        self.dtype = values.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def link(self, l):
+        # the stored epicenters of link l and their [n,M] intensities
+        start, stop = self.offsets[l], self.offsets[l + 1]
+        return self.epicenters[start:stop], self.values[start:stop]
+
+    def dense_link(self, l):
+        out = np.full(self.shape[1:], self.fill, dtype=self.dtype)
+        epicenters, values = self.link(l)
+        out[epicenters] = values
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            # the link axis is kept first when the links are selected by a slice or an array
+            links = self[key[0]]
+            return links[key[1:]] if isinstance(key[0], (int, np.integer)) else links[(slice(None),) + key[1:]]
+        if isinstance(key, (int, np.integer)):
+            return self.dense_link(range(self.shape[0])[key])
+        return np.stack([self.dense_link(l) for l in np.arange(self.shape[0])[key]])
+
+    @property
+    def density(self):
+        # fraction of the (link, epicenter) pairs stored
+        return len(self.epicenters) / (self.shape[0] * self.shape[1])
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.epicenters.nbytes + self.offsets.nbytes
+
+    def quantized(self):
+        # ceil(intensity) as uint8, see quantize_intensity_matrix
+        if self.dtype == np.uint8:
+            return self
+        return SparseIntensityMatrix(self.shape, self.offsets, self.epicenters, np.clip(np.ceil(self.values), 0, 255).astype(np.uint8),
+                                     self.tolerance, int(np.clip(np.ceil(self.fill), 0, 255)))
+
+    def save(self, npz_file):
+        np.savez(npz_file, shape=self.shape, offsets=self.offsets, epicenters=self.epicenters, values=self.values,
+                 tolerance=self.tolerance, fill=self.fill)
+
+    @classmethod
+    def load(cls, npz_file):
+        with np.load(npz_file) as f:
+            return cls(f['shape'], f['offsets'], f['epicenters'], f['values'], f['tolerance'].item(), f['fill'].item())
+
+def build_sparse_intensity_matrix(network, epicenters, magnitudes, attenuation=intensity_europe, tolerance=6, quantized=False):
+    # The intensities of the (link, epicenter) pairs within the cutoff radius of the largest magnitude at tolerance,
+    # equal to the ones of build_intensity_matrix (ceil as uint8 with quantized=True)
+    magnitudes = np.asarray(magnitudes, dtype=float)
+    radius = cutoff_distance(attenuation, magnitudes.max(), tolerance)
+    offsets, link_epicenters, values = [0], [], []
+    with span('sparse_intensity_matrix', radius_km=radius, tolerance=tolerance):
+        for link_epicenter, D in EpicenterIndex(epicenters).link_distances(network, radius):
+            intensity = np.maximum(attenuation(magnitudes[None, :], D[:, None]), 1.)
+            values.append(np.clip(np.ceil(intensity), 0, 255).astype(np.uint8) if quantized else intensity)
+            link_epicenters.append(link_epicenter)
+            offsets.append(offsets[-1] + len(link_epicenter))
+        shape = (network.number_of_edges(), len(epicenters), len(magnitudes))
+        values = np.concatenate(values) if values else np.zeros((0, len(magnitudes)), dtype=np.uint8 if quantized else float)
+        intensity = SparseIntensityMatrix(shape, offsets, np.concatenate(link_epicenters) if link_epicenters else [], values, tolerance)
+        annotate(density=intensity.density)
+    return intensity
+
+def get_sparse_intensity_matrix(network_file, probability_file, attenuation='europe', tolerance=6, cache_dir='intensities', quantized=True):
+    # Loads the sparse matrix from cache_dir, building it first, like get_intensity_matrix
+    network_name = os.path.splitext(os.path.basename(network_file))[0]
+    grid_name = os.path.splitext(os.path.basename(probability_file))[0]
+    key = intensity_cache_key(network_file, probability_file, attenuation)
+    path = os.path.join(cache_dir, f"{network_name}_{grid_name}_{attenuation}_{key}_sparse{tolerance}{'_u8' if quantized else ''}.npz")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        g = nx.read_gml(network_file, label='id')
+        epicenters, magnitudes, _ = read_earthquake_probabilities(probability_file)
+        intensity = build_sparse_intensity_matrix(g, epicenters, magnitudes, ATTENUATION_MODELS[attenuation], tolerance, quantized)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        intensity.save(tmp_path)
+        os.replace(tmp_path, path)
+        return intensity
+    return SparseIntensityMatrix.load(path)
+
+
+# Multi-resolution epicenter grid: a quadtree over a regular grid, whose cells are represented by one of their
+# epicenters with the probabilities of the cell summed. Merging moves the probability of the magnitudes between the
+# critical magnitude of an epicenter and the one of the representative across the failure boundary of a link; the
+# quadtree is only coarsened as long as that moved probability stays within max_error of the failure probability
+# of every link at every reachable tolerance level on the full grid, so it stays fine close to the links and
+# coarse where the cells do not change which links fail (max_error=0: only cells failing exactly the same way).
+def grid_step(epicenters):
+    # Spacing of a regular (Long, Lat) grid: the smallest difference between its distinct coordinates, per axis
+    steps = []
+    for axis in range(2):
+        coordinates = np.unique(np.round(np.asarray(epicenters, dtype=float)[:, axis], 9))
+        steps.append(np.diff(coordinates).min() if len(coordinates) > 1 else 1.)
+    return np.array(steps)
+
+def downsample_earthquake_grid(epicenters, prob_matrix, res):
+    # The uniform downsampling of the notebooks: epicenters snapped to a 1/res degree grid, probabilities summed
+    cells = pd.DataFrame(prob_matrix)
+    cells.insert(0, 'Long', (np.asarray(epicenters)[:, 0] * res).astype(int))
+    cells.insert(1, 'Lat', (np.asarray(epicenters)[:, 1] * res).astype(int))
+    cells = cells.groupby(['Long', 'Lat'], as_index=False).sum()
+    return cells[['Long', 'Lat']].to_numpy() / res, cells.drop(['Long', 'Lat'], axis=1).to_numpy()
+
+def build_multiresolution_grid(network, epicenters, magnitudes, prob_matrix, attenuation=intensity_europe, levels=range(6, 12), max_error=0.01, max_depth=6):
+    # Merges the epicenters of a regular grid bottom-up into quadtree cells of up to 2**max_depth x 2**max_depth
+    # points. A cell of four complete subcells is represented by the subcell representative moving the least
+    # probability, and the merges of every depth are accepted from the cheapest while the moved probability of every
+    # (link, level) stays within max_error times its failure probability.
+    # Returns the (Long, Lat) of the cell representatives, the [C,M] cell probabilities, the quadtree depth of every
+    # cell and the cell of every original epicenter.
+    epicenters = np.asarray(epicenters, dtype=float)
+    levels = np.asarray(levels)
+    with span('multiresolution_grid', epicenters=len(epicenters), max_error=max_error, max_depth=max_depth):
+        index = CriticalMagnitudeIndex(build_sparse_intensity_matrix(network, epicenters, magnitudes, attenuation, levels.min()), levels)
+        first = index.first.astype(np.int64)
+        suffix = index.suffix_sums(prob_matrix)
+        P = len(epicenters)
+        failing = suffix[np.arange(P), first]
+        budget = max_error * failing.sum(axis=-1)
+        spent = np.zeros_like(budget)
+
+        def moved(members, representative):
+            # [L,K] probability of the members moved across the failure boundaries by the representative
+            return np.abs(failing[:, :, members] - suffix[members, first[:, :, [representative]]]).sum(axis=-1)
+
+        grid = np.round((epicenters - epicenters.min(axis=0)) / grid_step(epicenters)).astype(np.int64)
+        # cell (depth, x, y): representative, members, moved probability
+        cells = {(0, x, y): (p, np.array([p]), np.zeros_like(budget)) for p, (x, y) in enumerate(grid)}
+        for d in range(1, max_depth + 1):
+            parents, sizes = np.unique(grid >> d, axis=0, return_counts=True)
+            size = {tuple(parent): n for parent, n in zip(parents, sizes)}
+            children = {}
+            for (depth, x, y), cell in cells.items():
+                if depth == d - 1:
+                    children.setdefault((x >> 1, y >> 1), []).append(cell)
+            candidates = []
+            for parent, subcells in children.items():
+                members = np.concatenate([members for _, members, _ in subcells])
+                if len(members) < size[parent]:
+                    # part of the parent is still finer
+                    continue
+                options = [(moved(members, representative), representative) for representative, _, _ in subcells]
+                cost, representative = min(options, key=lambda option: (option[0] / np.maximum(budget, 1e-300)).max())
+                delta = cost - sum(subcell_cost for _, _, subcell_cost in subcells)
+                candidates.append(((delta / np.maximum(budget, 1e-300)).max(), parent, representative, members, cost, delta))
+            merged = 0
+            for _, parent, representative, members, cost, delta in sorted(candidates, key=lambda c: c[0]):
+                if (spent + delta <= budget * (1 + 1e-9) + 1e-300).all():
+                    spent += delta
+                    for x in (2 * parent[0], 2 * parent[0] + 1):
+                        for y in (2 * parent[1], 2 * parent[1] + 1):
+                            cells.pop((d - 1, x, y), None)
+                    cells[(d, *parent)] = representative, members, cost
+                    merged += 1
+            if not merged:
+                break
+
+        cell_list = sorted(cells.items())
+        cell_of = np.empty(P, dtype=np.int64)
+        cell_probabilities = np.zeros((len(cell_list), prob_matrix.shape[1]))
+        for c, (_, (_, members, _)) in enumerate(cell_list):
+            cell_of[members] = c
+            cell_probabilities[c] = prob_matrix[members].sum(axis=0)
+        representatives = np.array([representative for _, (representative, _, _) in cell_list])
+        depths = np.array([depth for (depth, _, _), _ in cell_list])
+        annotate(cells=len(cell_list))
+        count('grid_cells', len(cell_list))
+    return epicenters[representatives], cell_probabilities, depths, cell_of
+
+def write_earthquake_probabilities(csv_file, epicenters, magnitudes, prob_matrix):
+    # The layout read by read_earthquake_probabilities
+    df = pd.DataFrame(prob_matrix, columns=[f'{m:.1f}' for m in magnitudes])
+    df.insert(0, 'Long', np.asarray(epicenters)[:, 0])
+    df.insert(1, 'Lat', np.asarray(epicenters)[:, 1])
+    df.to_csv(csv_file, index=False)
+
+def grid_error_report(network, cut_srlgs, grids, magnitudes, attenuation=intensity_europe, tolerances=range(6, 12)):
+    # Error of coarser earthquake grids against the first one of grids ({name: (epicenters, prob_matrix)}): the number
+    # of scenarios, the largest error of the failure probability of a link, and the probability of falling apart
+    # with every link at the same tolerance (absolute and relative error)
+    network = compile_network(network, cut_srlgs)
+    rows, reference = [], None
+    for name, (epicenters, prob_matrix) in grids.items():
+        index = CriticalMagnitudeIndex(build_sparse_intensity_matrix(network.network, epicenters, magnitudes, attenuation, min(tolerances)), tolerances)
+        link_probabilities = np.array([[index.occurrence_probability(index.link_failures(l, t), prob_matrix) for t in tolerances] for l in range(len(network))])
+        falling_apart = np.array([get_probability_of_falling_apart(cut_srlgs, network, index, np.full(len(network), t), prob_matrix) for t in tolerances])
+        if reference is None:
+            reference = link_probabilities, falling_apart
+        row = {'Grid': name, 'Epicenters': len(epicenters), 'Scenarios': prob_matrix.size,
+               'Max link error': np.abs(link_probabilities - reference[0]).max()}
+        for t, p, p_ref in zip(tolerances, falling_apart, reference[1]):
+            row[f'Falling apart H={t}'] = p
+            row[f'Relative error H={t}'] = abs(p - p_ref) / p_ref if p_ref > 0 else 0.
+        rows.append(row)
+    return pd.DataFrame(rows)
+
 
 # Graph and SRLG calculations
 def remains_connected(g, srlg):
@@ -41,45 +451,203 @@ def reamins_k_connected(g, srlg):
     g.remove_edges_from(srlg)
     return nx.is_k_edge_connected(g.to_undirected())
 
+def iter_SRLGs(PSRLG_file):
+    # Streams (srlg, probability) for every PSRLG of the XML log, dropping each element once it is parsed
+    srlg_list = None
+    for event, elem in ET.iterparse(PSRLG_file, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'PSRLGList':
+                srlg_list = elem
+            continue
+        if elem.tag == 'PSRLG':
+        #if elem.tag == 'Failure_State':
+            # (edge_id, node_id, node_id)
+            #srlg = set([ (int(edge[1]), int(edge[2]), 0) if edge[0] != '24' else (int(edge[1]), int(edge[2]), 1) for edge in re.findall(r"(\d+):\((\d+)\D+(\d+)\D+\)", elem.find('Edges').text)])
+            srlg = set([ (int(edge[1]), int(edge[2]), 0) for edge in re.findall(r"(\d+):\((\d+)\D+(\d+)\)", elem.find('Edges').text or '')])
+            probability = float(elem.find('Probability').text.strip())
+            #rate = float(elem.find('Rate').text.strip())
+            yield srlg, probability
+            if srlg_list is not None:
+                srlg_list.remove(elem)
+
+class EdgeConnectivity:
+    # The edges of a graph as integer node index pairs, to check whether the graph remains connected after removing
+    # an SRLG with union-find, instead of copying the graph. Edges not in the graph are ignored like remove_edges_from does,
+    # (u, v) pairs remove the last added parallel edge between u and v.
+    def __init__(self, g):
+        node_index = {n: i for i, n in enumerate(g.nodes)}
+        self.n_nodes = len(node_index)
+        edges = list(g.edges(keys=True)) if g.is_multigraph() else [(u, v, 0) for u, v in g.edges]
+        self.pairs = [(node_index[u], node_index[v]) for u, v, _ in edges]
+        self.edge_index = {}
+        self.parallel_edges = {}
+        for idx, (u, v, k) in enumerate(edges):
+            self.edge_index[u, v, k] = self.edge_index[v, u, k] = idx
+            self.parallel_edges.setdefault((u, v), []).append(idx)
+            if u != v:
+                self.parallel_edges.setdefault((v, u), []).append(idx)
+
+    def removed_edges(self, srlg):
+        removed = set()
+        for e in srlg:
+            if len(e) == 3:
+                if e in self.edge_index:
+                    removed.add(self.edge_index[e])
+            else:
+                remaining = [idx for idx in self.parallel_edges.get(tuple(e), []) if idx not in removed]
+                if remaining:
+                    removed.add(remaining[-1])
+        return removed
+
+    def remains_connected(self, srlg):
+        return self.remains_connected_without(self.removed_edges(srlg))
+
+    def remains_connected_without(self, removed):
+        # removed: set of edge indices
+        parent = list(range(self.n_nodes))
+        components = self.n_nodes
+        for idx, (a, b) in enumerate(self.pairs):
+            if components == 1:
+                break
+            if idx in removed:
+                continue
+            while parent[a] != a:
+                parent[a] = a = parent[parent[a]]
+            while parent[b] != b:
+                parent[b] = b = parent[parent[b]]
+            if a != b:
+                parent[a] = b
+                components -= 1
+        return components == 1
+
+class CutOracle:
+    # Answers whether an SRLG disconnects the graph. Bridges and 2-edge cuts are precomputed, so single and double
+    # failures are set lookups, larger SRLGs fall back to union-find.
+    def __init__(self, g):
+        self.connectivity = EdgeConnectivity(g)
+        self.connected = self.connectivity.remains_connected(())
+        edges = list(g.edges(keys=True)) if g.is_multigraph() else list(g.edges)
+        self.bridges = set(self._bridges(g))
+        self.cut_pairs = set()
+        if self.connected:
+            for idx, e in enumerate(edges):
+                if idx not in self.bridges:
+                    h = g.copy()
+                    h.remove_edge(*e)
+                    self.cut_pairs.update(frozenset((idx, other)) for other in self._bridges(h))
+
+    def _bridges(self, g):
+        for u, v in nx.bridges(g):
+            # a bridge has no parallel edge
+            k = next(iter(g[u][v])) if g.is_multigraph() else 0
+            yield self.connectivity.edge_index[u, v, k]
+
+    def is_cut(self, srlg):
+        return self.is_cut_without(self.connectivity.removed_edges(srlg))
+
+    def is_cut_without(self, removed):
+        # removed: set of edge indices
+        if not self.connected:
+            return True
+        if removed & self.bridges:
+            return True
+        if len(removed) < 2:
+            return False
+        if len(removed) == 2:
+            return frozenset(removed) in self.cut_pairs
+        return not self.connectivity.remains_connected_without(removed)
+
+_cut_worker = {}
+
+def _init_cut_worker(oracle):
+    _cut_worker['oracle'] = oracle
+
+def _cut_statuses(srlgs):
+    return [_cut_worker['oracle'].is_cut(srlg) for srlg in srlgs]
+
+def get_cut_statuses(srlgs, g, processes=None, chunksize=2000):
+    # For every SRLG whether removing it disconnects g. The SRLGs of more than two links are checked in chunks
+    # across a process pool when there are more of them than one chunk.
+    oracle = g if isinstance(g, CutOracle) else CutOracle(g)
+    statuses = [None] * len(srlgs)
+    remaining = []
+    for i, srlg in enumerate(srlgs):
+        if len(srlg) > 2:
+            remaining.append(i)
+        else:
+            statuses[i] = oracle.is_cut(srlg)
+    if processes == 1 or len(remaining) <= chunksize:
+        for i in remaining:
+            statuses[i] = oracle.is_cut(srlgs[i])
+    else:
+        chunks = [[srlgs[i] for i in remaining[start:start + chunksize]] for start in range(0, len(remaining), chunksize)]
+        with mp.Pool(processes, _init_cut_worker, (oracle,)) as pool:
+            results = pool.map(_cut_statuses, chunks)
+        for i, status in zip(remaining, (status for chunk in results for status in chunk)):
+            statuses[i] = status
+    return statuses
+
+class MinimalCutIndex:
+    # The cut SRLGs collected so far, with an inverted link -> cut positions index, so that finding the first
+    # cut which is a subset or a superset of a new SRLG does not scan every cut
+    def __init__(self):
+        self.cut_srlgs = []
+        self.link_cuts = {}
+        self.empty_cuts = set()
+
+    def _index(self, i, add=True):
+        s = self.cut_srlgs[i]
+        if not s:
+            (self.empty_cuts.add if add else self.empty_cuts.discard)(i)
+        for l in s:
+            if add:
+                self.link_cuts.setdefault(l, set()).add(i)
+            else:
+                self.link_cuts[l].discard(i)
+
+    def first_comparable(self, srlg):
+        # position of the first cut containing the SRLG or contained in it
+        if not srlg:
+            return 0 if self.cut_srlgs else None
+        containing = set.intersection(*(self.link_cuts.get(l, set()) for l in srlg))
+        hits = {}
+        for l in srlg:
+            for i in self.link_cuts.get(l, ()):
+                hits[i] = hits.get(i, 0) + 1
+        contained = [i for i, n in hits.items() if n == len(self.cut_srlgs[i])]
+        candidates = containing.union(contained, self.empty_cuts)
+        return min(candidates) if candidates else None
+
+    def add(self, srlg):
+        # Same rule as the list scan: a smaller SRLG replaces the first cut containing it,
+        # a larger one is dropped, an incomparable one is appended
+        i = self.first_comparable(srlg)
+        if i is None:
+            self.cut_srlgs.append(srlg)
+            self._index(len(self.cut_srlgs) - 1)
+        elif srlg.issubset(self.cut_srlgs[i]):
+            self._index(i, add=False)
+            self.cut_srlgs[i] = srlg
+            self._index(i)
+
 def get_minimal_cut_SRLGs(PSRLG_file, g):
-    xtree = ET.parse(PSRLG_file)
-    xroot = xtree.getroot().find('PSRLGList')
-    cut_srlgs = []
-    for fs in tqdm(xroot.iter('PSRLG'), total=len(xroot.findall('PSRLG'))):
-    #for fs in tqdm(xroot.iter('Failure_State'), total=len(xroot.findall('Failure_State'))):
-        # (edge_id, node_id, node_id)
-        #srlg = set([ (int(edge[1]), int(edge[2]), 0) if edge[0] != '24' else (int(edge[1]), int(edge[2]), 1) for edge in re.findall(r"(\d+):\((\d+)\D+(\d+)\D+\)", fs.find('Edges').text)])
-        srlg = set([ (int(edge[1]), int(edge[2]), 0) for edge in re.findall(r"(\d+):\((\d+)\D+(\d+)\)", fs.find('Edges').text)])
-        probability = float(fs.find('Probability').text.strip())
-        #print(fs.find('Edges').text)
-        #print(probability, srlg)
-        if not remains_connected(g.copy(), srlg):# and probability>10**-5:
-            added = False
-            for i, s in enumerate(cut_srlgs):
-                if srlg.issubset(s):
-                    cut_srlgs[i] = srlg
-                    added = True
-                    break
-                elif srlg.issuperset(s):
-                    added = True
-                    break
-            if not cut_srlgs or not added:
-                cut_srlgs.append(srlg)
-    return cut_srlgs
+    with span('minimal_cut_SRLGs', PSRLG_file=PSRLG_file):
+        connectivity = EdgeConnectivity(g)
+        cuts = MinimalCutIndex()
+        n = 0
+        for n, (srlg, probability) in enumerate(progress(iter_SRLGs(PSRLG_file), desc='PSRLGs'), 1):
+            #print(probability, srlg)
+            if not connectivity.remains_connected(srlg):# and probability>10**-5:
+                cuts.add(srlg)
+        count('PSRLGs', n)
+        count('cut_SRLGs', len(cuts.cut_srlgs))
+        return cuts.cut_srlgs
 
 def get_SRLGs(PSRLG_file):
-    xtree = ET.parse(PSRLG_file)
-    xroot = xtree.getroot().find('PSRLGList')
     srlgs = []
     probabilities = []
     rates = []
-    for fs in xroot.iter('PSRLG'):
-    #for fs in tqdm(xroot.iter('Failure_State'), total=len(xroot.findall('Failure_State'))):
-        # (edge_id, node_id, node_id)
-        #srlg = set([ (int(edge[1]), int(edge[2]), 0) if edge[0] != '24' else (int(edge[1]), int(edge[2]), 1) for edge in re.findall(r"(\d+):\((\d+)\D+(\d+)\D+\)", fs.find('Edges').text)])
-        srlg = set([ (int(edge[1]), int(edge[2]), 0) for edge in re.findall(r"(\d+):\((\d+)\D+(\d+)\)", fs.find('Edges').text)])
-        probability = float(fs.find('Probability').text.strip())
-        #rate = float(fs.find('Rate').text.strip())
+    for srlg, probability in iter_SRLGs(PSRLG_file):
         #print(probability, srlg)
         #if probability > 10**-5:
         if srlg:
@@ -89,13 +657,272 @@ def get_SRLGs(PSRLG_file):
     return srlgs, probabilities#, rates
 
 
-def get_SRLG_probability(srlg, network, intensity_matrix, intensity_tolerance, probability_matrix):
-    edges = list(network.edges)
+# Compact SRLG storage: CSR-style offsets + int32 link indices + float64 probabilities
+def get_SRLGs_csr(PSRLG_file, network):
+    network = compile_network(network)
+    offsets, links, probabilities = array('q', [0]), array('i'), array('d')
+    for srlg, probability in iter_SRLGs(PSRLG_file):
+        if srlg:
+            links.extend(network.srlg_indices(srlg).tolist())
+            offsets.append(len(links))
+            probabilities.append(probability)
+    return np.frombuffer(offsets, dtype=np.int64), np.frombuffer(links, dtype=np.int32), np.frombuffer(probabilities, dtype=np.float64)
+
+def csr_to_SRLGs(offsets, links, network):
+    edges = compile_network(network).edges
+    return [set(edges[l] for l in links[offsets[i]:offsets[i+1]]) for i in range(len(offsets) - 1)]
+
+def save_SRLGs_npz(npz_file, offsets, links, probabilities, network):
+    # uncompressed, so that load_SRLGs_npz can memory-map the arrays
+    edges = np.array(compile_network(network).edges, dtype=np.int64)
+    np.savez(npz_file, offsets=offsets, links=links, probabilities=probabilities, edges=edges)
+
+def _memmap_npz(npz_file):
+    arrays = {}
+    with zipfile.ZipFile(npz_file) as zf, open(npz_file, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'{npz_file} is compressed and cannot be memory-mapped')
+            # local file header: 30 bytes, then the file name and the extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            order = 'F' if fortran_order else 'C'
+            arrays[info.filename[:-len('.npy')]] = np.memmap(npz_file, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order=order)
+    return arrays
+
+def load_SRLGs_npz(npz_file, network=None, mmap=True):
+    arrays = _memmap_npz(npz_file) if mmap else dict(np.load(npz_file))
+    if network is not None and not np.array_equal(arrays['edges'], np.array(compile_network(network).edges, dtype=np.int64).reshape(arrays['edges'].shape)):
+        raise ValueError(f'{npz_file} was saved for a different edge list')
+    return arrays['offsets'], arrays['links'], arrays['probabilities']
+
+def get_cached_SRLGs_csr(PSRLG_file, network, npz_file=None):
+    # Parses the XML only if the .npz next to it is missing or older, memory-maps the arrays otherwise
+    npz_file = npz_file or os.path.splitext(PSRLG_file)[0] + '.npz'
+    if os.path.exists(npz_file) and os.path.getmtime(npz_file) >= os.path.getmtime(PSRLG_file):
+        try:
+            return load_SRLGs_npz(npz_file, network)
+        except ValueError:
+            pass
+    offsets, links, probabilities = get_SRLGs_csr(PSRLG_file, network)
+    save_SRLGs_npz(npz_file, offsets, links, probabilities, network)
+    return load_SRLGs_npz(npz_file, network)
+
+
+# Compiled network
+class CompiledNetwork:
+    # The link data the probability and heuristic functions need, precomputed from the networkx MultiGraph:
+    # the edge -> index dict, the lengths and onspine flags as arrays, and the SRLGs as link index arrays.
+    # Every function taking a network accepts either form.
+    def __init__(self, network, srlgs=()):
+        self.network = network
+        self.edges = list(network.edges)
+        self.edge_index = {e: idx for idx, e in enumerate(self.edges)}
+        self._length = np.array([network.edges[e].get('length', np.nan) for e in self.edges], dtype=float)
+        self._missing_length = [e for e in self.edges if 'length' not in network.edges[e]]
+        self.onspine = np.array([network.edges[e].get('onspine', 0) for e in self.edges], dtype=int)
+        self._srlg_indices = {}
+        for srlg in srlgs:
+            self.srlg_indices(srlg)
+
+    def __len__(self):
+        return len(self.edges)
+
+    @property
+    def length(self):
+        # only the functions using the lengths need them
+        if self._missing_length:
+            raise ValueError(f'Edges without a length: {self._missing_length}')
+        return self._length
+
+    def number_of_edges(self):
+        return len(self.edges)
+
+    def index(self, edge):
+        return self.edge_index[edge]
+
+    def srlg_indices(self, srlg):
+        key = frozenset(srlg)
+        if key not in self._srlg_indices:
+            self._srlg_indices[key] = np.array([self.edge_index[l] for l in srlg], dtype=int)
+        return self._srlg_indices[key]
+
+def compile_network(network, srlgs=()):
+    if isinstance(network, CompiledNetwork):
+        for srlg in srlgs:
+            network.srlg_indices(srlg)
+        return network
+    return CompiledNetwork(network, srlgs)
+
+
+# Link failure events
+def _level_index(levels, tolerance):
+    idx = int(tolerance) - levels[0]
+    if idx != tolerance - levels[0] or not 0 <= idx < len(levels):
+        raise ValueError(f'Intensity tolerance {tolerance} is not one of the indexed levels {list(levels)}')
+    return idx
+
+class LinkFailureBitsets:
+    # intensity_matrix[l] > level for every link and integer tolerance level, packed to bits over the flattened [P,M] grid.
+    # Can be passed in place of the intensity matrix to the SRLG probability functions, as long as the tolerances are levels.
+    def __init__(self, intensity_matrix, levels=range(6, 12)):
+        self.shape = intensity_matrix.shape
+        self.levels = np.asarray(levels)
+        self.size = int(np.prod(self.shape[1:]))
+        self.bits = np.stack([np.packbits(intensity_matrix[l].reshape(1, -1) > self.levels[:, None], axis=-1) for l in range(self.shape[0])])
+
+    def level_index(self, tolerance):
+        return _level_index(self.levels, tolerance)
+
+    def link_failures(self, l_idx, tolerance):
+        return self.bits[l_idx, self.level_index(tolerance)]
+
+    def srlg_occurrence(self, l_idxs, tolerances):
+        srlg_occur = np.full(self.bits.shape[-1], fill_value=0xFF, dtype=np.uint8)
+        for l_idx, tolerance in zip(l_idxs, tolerances):
+            srlg_occur &= self.link_failures(l_idx, tolerance)
+        return srlg_occur
+
+    def occurrence_mask(self, occurrence):
+        return np.unpackbits(occurrence, count=self.size).view(bool).reshape(self.shape[1:])
+
+    def occurrence_probability(self, occurrence, probability_matrix):
+        return np.unpackbits(occurrence, count=self.size) @ probability_matrix.reshape(-1)
+
+class CriticalMagnitudeIndex:
+    # Intensity grows with the magnitude, so the magnitudes failing a link at an epicenter are a suffix of the magnitude
+    # axis. first[l,k,p] is the index of the smallest magnitude with intensity_matrix[l,p,m] > levels[k] (M if none).
+    # An occurrence is the [P] start of the failing suffix: intersection is the maximum, union the minimum, and the
+    # probability is a lookup in the suffix sums of the probability matrix.
+    # Can be passed in place of the intensity matrix to the SRLG probability functions, as long as the tolerances are levels.
+    def __init__(self, intensity_matrix, levels=range(6, 12)):
+        self.shape = intensity_matrix.shape
+        self.levels = np.asarray(levels)
+        L, P, M = self.shape
+        self.first = np.empty((L, len(self.levels), P), dtype=np.uint8 if M < 256 else np.uint16)
+        sparse = isinstance(intensity_matrix, SparseIntensityMatrix)
+        if sparse and self.levels.min() < intensity_matrix.tolerance:
+            raise ValueError(f'Levels below the tolerance {intensity_matrix.tolerance} of the sparse intensity matrix')
+        for l in range(L):
+            if sparse:
+                # the pairs outside the cutoff radius never fail
+                epicenters, link_intensity = intensity_matrix.link(l)
+                self.first[l] = M
+            else:
+                epicenters, link_intensity = slice(None), np.asarray(intensity_matrix[l])
+            if (link_intensity[..., 1:] < link_intensity[..., :-1]).any():
+                raise ValueError(f'The intensities of link {l} are not increasing along the magnitude axis')
+            self.first[l][:, epicenters] = (link_intensity[None] <= self.levels[:, None, None]).sum(axis=-1)
+        self._suffix_sums = None
+        self._scenario_positions = None, None
+
+    def level_index(self, tolerance):
+        return _level_index(self.levels, tolerance)
+
+    def link_failures(self, l_idx, tolerance):
+        return self.first[l_idx, self.level_index(tolerance)]
+
+    def srlg_occurrence(self, l_idxs, tolerances):
+        srlg_occur = np.zeros(self.shape[1], dtype=self.first.dtype)
+        for l_idx, tolerance in zip(l_idxs, tolerances):
+            np.maximum(srlg_occur, self.link_failures(l_idx, tolerance), out=srlg_occur)
+        return srlg_occur
+
+    def scenario_failures(self, l_idx, tolerance, scenarios=slice(None)):
+        # link failures over the flattened [P*M] scenarios, or only in the given scenario indices
+        first = self.link_failures(l_idx, tolerance)
+        if isinstance(scenarios, slice):
+            return self.occurrence_mask(first).reshape(-1)[scenarios]
+        if self._scenario_positions[0] is not scenarios:
+            # the evaluator asks for the same scenarios with every link of the SRLGs
+            self._scenario_positions = scenarios, np.divmod(scenarios, self.shape[2])
+        p, m = self._scenario_positions[1]
+        return m >= first[p]
+
+    def flipping_scenarios(self, l_idx, lower_tolerance):
+        # flattened indices of the scenarios failing the link at lower_tolerance but not at lower_tolerance + 1,
+        # the magnitudes first[l,k,p] .. first[l,k+1,p]-1 of every epicenter
+        lo = self.link_failures(l_idx, lower_tolerance).astype(np.int64)
+        hi = self.link_failures(l_idx, lower_tolerance + 1).astype(np.int64)
+        counts = hi - lo
+        p = np.repeat(np.arange(self.shape[1]), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return p * self.shape[2] + lo[p] + offsets
+
+    def occurrence_union(self, occurrence, other):
+        return np.minimum(occurrence, other)
+
+    def occurrence_mask(self, occurrence):
+        return np.arange(self.shape[2]) >= occurrence[:, None]
+
+    def suffix_sums(self, probability_matrix):
+        # [P,M+1], suffix_sums[p,j] is the probability of the magnitudes j.. at epicenter p
+        if self._suffix_sums is None or self._suffix_sums[0] is not probability_matrix:
+            suffix = np.zeros((self.shape[1], self.shape[2] + 1))
+            suffix[:, :-1] = np.cumsum(probability_matrix[:, ::-1], axis=1)[:, ::-1]
+            self._suffix_sums = probability_matrix, suffix
+        return self._suffix_sums[1]
+
+    def occurrence_probability(self, occurrence, probability_matrix):
+        return self.suffix_sums(probability_matrix)[np.arange(self.shape[1]), occurrence].sum()
+
+def get_link_failures(intensity_matrix, l_idx, tolerance):
+    # [P,M] mask of the scenarios in which the link fails
+    if hasattr(intensity_matrix, 'occurrence_mask'):
+        return intensity_matrix.occurrence_mask(intensity_matrix.link_failures(l_idx, tolerance))
+    return intensity_matrix[l_idx] > tolerance
+
+def get_SRLG_occurrence(srlg, network, intensity_matrix, intensity_tolerance):
+    # [P,M] mask of the scenarios in which every link of the SRLG fails (packed bits for LinkFailureBitsets)
+    l_idxs = compile_network(network).srlg_indices(srlg)
+    if hasattr(intensity_matrix, 'srlg_occurrence'):
+        return intensity_matrix.srlg_occurrence(l_idxs, [intensity_tolerance[l_idx] for l_idx in l_idxs])
     srlg_occur = np.full(intensity_matrix.shape[1:], fill_value=True, dtype=bool)
-    for l in srlg:
-        l_idx = edges.index(l)
+    for l_idx in l_idxs:
         srlg_occur &= intensity_matrix[l_idx] > intensity_tolerance[l_idx]
-    return probability_matrix[srlg_occur].sum()
+    return srlg_occur
+
+def get_occurrence_probability(occurrence, intensity_matrix, probability_matrix):
+    if hasattr(intensity_matrix, 'occurrence_probability'):
+        return intensity_matrix.occurrence_probability(occurrence, probability_matrix)
+    return probability_matrix[occurrence].sum()
+
+def get_SRLG_probability(srlg, network, intensity_matrix, intensity_tolerance, probability_matrix):
+    srlg_occur = get_SRLG_occurrence(srlg, network, intensity_matrix, intensity_tolerance)
+    return get_occurrence_probability(srlg_occur, intensity_matrix, probability_matrix)
+
+def get_SRLG_probabilities(offsets, links, intensity_matrix, intensity_tolerance, probability_matrix, chunk_bytes=1 << 26):
+    # Probability of every SRLG of a CSR list (offsets, link indices) in one pass over a CriticalMagnitudeIndex:
+    # the failing suffix of an SRLG starts at the maximum of its links' first failing magnitudes, and its probability
+    # is the sum of the suffix sums at those starts. The SRLGs are taken by size, so the maximum is over a
+    # [SRLGs, size, P] block. Other intensity matrices get an index over the levels of intensity_tolerance,
+    # LinkFailureBitsets are evaluated SRLG by SRLG.
+    intensity_tolerance = np.asarray(intensity_tolerance)
+    if isinstance(intensity_matrix, LinkFailureBitsets):
+        srlgs = (links[offsets[s]:offsets[s+1]] for s in range(len(offsets) - 1))
+        return np.array([get_occurrence_probability(intensity_matrix.srlg_occurrence(s, intensity_tolerance[s]), intensity_matrix, probability_matrix) for s in srlgs])
+    if not isinstance(intensity_matrix, CriticalMagnitudeIndex):
+        intensity_matrix = CriticalMagnitudeIndex(intensity_matrix, range(int(intensity_tolerance.min()), int(intensity_tolerance.max()) + 1))
+    index = intensity_matrix
+    L, P, M = index.shape
+    first = index.first[np.arange(L), [index.level_index(t) for t in intensity_tolerance]]
+    suffix = index.suffix_sums(probability_matrix).reshape(-1)
+    rows = np.arange(P) * (M + 1)
+    offsets, links = np.asarray(offsets), np.asarray(links)
+    sizes = np.diff(offsets)
+    probabilities = np.zeros(len(sizes))
+    for size in np.unique(sizes[sizes > 0]):
+        srlgs = np.flatnonzero(sizes == size)
+        step = max(1, chunk_bytes // (size * P))
+        for start in range(0, len(srlgs), step):
+            chunk = srlgs[start:start + step]
+            starts = first[links[offsets[chunk][:, None] + np.arange(size)]].max(axis=1)
+            probabilities[chunk] = np.take(suffix, starts + rows).sum(axis=1)
+    return probabilities
 
 
 # Networkx and lgf conversions
@@ -165,23 +992,24 @@ def write_networkx_to_lgf(G, network_name, extended=False):
     return 0
 
 
-def write_networkx_to_srg(network_name, G, SRLGs):
-    f = open(str(network_name), 'w')
-    f.write('@nodes\n')
-    f.write('label\tcoords\tunav\n')
+def _srg_header(G):
+    # the @nodes and @edges sections, the same for every SRLG list of the network
+    lines = ['@nodes\n', 'label\tcoords\tunav\n']
     for node, attr in G.nodes(data=True):
-        f.write(str(node) + '\t(' + str(attr['Latitude']) + ',' + str(attr['Longitude']) + ')\t0\n')
-    f.write('@edges\n')
-    f.write('\t\tlabel\tonspine\tunav\n')
+        lines.append(str(node) + '\t(' + str(attr['Latitude']) + ',' + str(attr['Longitude']) + ')\t0\n')
+    lines += ['@edges\n', '\t\tlabel\tonspine\tunav\n']
     for label,(u,v) in enumerate(G.edges()):
         e = G[u][v][0]
-        line = str("%d\t%d\t%d\t%d\t%.10f\n" % (u, v, label, e['onspine'], e['unav']))
-        f.write(line)
+        lines.append("%d\t%d\t%d\t%d\t%.10f\n" % (u, v, label, e['onspine'], e['unav']))
     for label,(u,v) in enumerate(reversed(list(G.edges())), start=len(G.edges)):
         e = G[u][v][0]
-        line = str("%d\t%d\t%d\t%d\t%.10f\n" % (v, u, label, e['onspine'], e['unav']))
-        f.write(line)
-    f.write('@srgs\n')
+        lines.append("%d\t%d\t%d\t%d\t%.10f\n" % (v, u, label, e['onspine'], e['unav']))
+    lines.append('@srgs\n')
+    return ''.join(lines)
+
+def write_networkx_to_srg(network_name, G, SRLGs):
+    f = open(str(network_name), 'w')
+    f.write(_srg_header(G))
     for i, srlg in enumerate(SRLGs):
         f.write(f'{str(i+1)} 0\n')
         line = ''
@@ -191,41 +1019,170 @@ def write_networkx_to_srg(network_name, G, SRLGs):
     f.close()
     return 0
 
+def write_srg_buckets(srg_files, G, offsets, links, srlg_probabilities, Ts, buffering=1 << 20):
+    # The .srg files of the SRLGs (CSR offsets and link indices) more probable than each T, srg_files[i] for Ts[i].
+    # The header and the line of every SRLG are formatted once, each file is written with a single call.
+    edges = compile_network(G).edges
+    header = _srg_header(G)
+    link_tokens = [f'{e[0]}-{e[1]} {e[1]}-{e[0]} ' for e in edges]
+    srlg_probabilities = np.asarray(srlg_probabilities)
+    lines = {}
+    for srg_file, T in zip(srg_files, Ts):
+        active = np.flatnonzero(srlg_probabilities > T)
+        for s in active:
+            if s not in lines:
+                lines[s] = ''.join(link_tokens[l] for l in links[offsets[s]:offsets[s+1]]) + '\n'
+        with open(str(srg_file), 'w', buffering=buffering) as f:
+            f.write(header + ''.join(f'{i+1} 0\n{lines[s]}' for i, s in enumerate(active)))
+
 
 # Heuristics
 
 def get_probability_of_falling_apart(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix):
-    edges = list(network.edges)
-    cut_occur = np.full(intensity_matrix.shape[1:], fill_value=False, dtype=bool)
+    cut_occur = None
     for srlg in srlgs:
-        srlg_occur = np.full(intensity_matrix.shape[1:], fill_value=True, dtype=bool)
-        for l in srlg:
-            l_idx = edges.index(l)
-            srlg_occur &= intensity_matrix[l_idx] > intensity_tolerance[l_idx]
-        cut_occur |= srlg_occur
-    return probability_matrix[cut_occur].sum()
+        srlg_occur = get_SRLG_occurrence(srlg, network, intensity_matrix, intensity_tolerance)
+        if cut_occur is None:
+            cut_occur = srlg_occur
+        elif hasattr(intensity_matrix, 'occurrence_union'):
+            cut_occur = intensity_matrix.occurrence_union(cut_occur, srlg_occur)
+        else:
+            cut_occur = cut_occur | srlg_occur
+    if cut_occur is None:
+        return 0.
+    return get_occurrence_probability(cut_occur, intensity_matrix, probability_matrix)
+
+def get_scenario_probability_of_falling_apart(network, intensity_matrix, intensity_tolerance, probability_matrix, chunk_size=65536):
+    # Exact probability of the network falling apart, independent of the cut SRLG list: the failed links of every
+    # (p,m) scenario are packed into a bitmask row, and each distinct row is checked for connectivity only once
+    network = compile_network(network)
+    oracle = CutOracle(network.network)
+    L = len(network)
+    failed = np.stack([get_link_failures(intensity_matrix, l, intensity_tolerance[l]).reshape(-1) for l in range(L)])
+    probabilities = probability_matrix.reshape(-1)
+    statuses = {}
+    probability = 0.
+    for start in range(0, failed.shape[1], chunk_size):
+        signatures, inverse = np.unique(np.packbits(failed[:, start:start + chunk_size], axis=0).T, axis=0, return_inverse=True)
+        cut = np.zeros(len(signatures), dtype=bool)
+        for i, signature in enumerate(signatures):
+            key = signature.tobytes()
+            if key not in statuses:
+                statuses[key] = oracle.is_cut_without(set(np.flatnonzero(np.unpackbits(signature, count=L))))
+            cut[i] = statuses[key]
+        probability += probabilities[start:start + chunk_size][cut[inverse.reshape(-1)]].sum()
+    return probability
+
+# Sampled scenarios: on grids too large to evaluate every (p,m) scenario in the heuristic loops, N scenarios are drawn
+# with importance sampling and every probability is estimated from them. The proposal is prob_matrix times the number
+# of links failing at the smallest level to the power importance (0: proportional to prob_matrix), over the scenarios
+# failing at least min_failing links, so high magnitudes and epicenters close to the links are drawn more often.
+# The scenarios failing no link at the smallest level cannot disconnect the network at any higher tolerance.
+class ScenarioSample:
+    # Can be passed in place of the intensity matrix, with sample.weights in place of the probability matrix, to the
+    # SRLG probability functions and to FallingApartEvaluator, as long as the tolerances are levels. The sampled
+    # scenarios are the S epicenters of a [L,S,1] cube; a scenario drawn k times weighs k * prob / (N * proposal).
+    def __init__(self, intensity_matrix, probability_matrix, n_samples, levels=range(6, 12), importance=1., min_failing=1, seed=0):
+        self.levels = np.asarray(levels)
+        L, P, M = intensity_matrix.shape
+        probabilities = np.asarray(probability_matrix, dtype=float).reshape(-1)
+        failing = np.zeros(P * M, dtype=np.int32)
+        for l in range(L):
+            failing += get_link_failures(intensity_matrix, l, self.levels[0]).reshape(-1)
+        proposal = probabilities * (failing >= min_failing) * failing.astype(float) ** importance
+        if proposal.sum() <= 0:
+            raise ValueError(f'No scenario fails {min_failing} links at intensity {self.levels[0]}')
+        proposal /= proposal.sum()
+        rng = np.random.default_rng(seed)
+        self.scenarios, self.draws = np.unique(rng.choice(P * M, size=n_samples, p=proposal), return_counts=True)
+        self.n_samples = n_samples
+        # probability / proposal of every sampled scenario, the estimate of a probability is the mean over the draws
+        self.likelihood_ratios = probabilities[self.scenarios] / proposal[self.scenarios]
+        self.weights = (self.draws * self.likelihood_ratios / n_samples).reshape(-1, 1)
+        self.shape = (L, len(self.scenarios), 1)
+        self.failures = np.empty((L, len(self.levels), len(self.scenarios)), dtype=bool)
+        for l in range(L):
+            for k, level in enumerate(self.levels):
+                if hasattr(intensity_matrix, 'scenario_failures'):
+                    self.failures[l, k] = intensity_matrix.scenario_failures(l, level, self.scenarios)
+                else:
+                    self.failures[l, k] = get_link_failures(intensity_matrix, l, level).reshape(-1)[self.scenarios]
+        annotate(samples=n_samples, sampled_scenarios=len(self.scenarios))
+
+    def level_index(self, tolerance):
+        return _level_index(self.levels, tolerance)
+
+    def link_failures(self, l_idx, tolerance):
+        return self.failures[l_idx, self.level_index(tolerance)]
+
+    def srlg_occurrence(self, l_idxs, tolerances):
+        srlg_occur = np.ones(self.shape[1], dtype=bool)
+        for l_idx, tolerance in zip(l_idxs, tolerances):
+            srlg_occur &= self.link_failures(l_idx, tolerance)
+        return srlg_occur
+
+    def scenario_failures(self, l_idx, tolerance, scenarios=slice(None)):
+        return self.link_failures(l_idx, tolerance)[scenarios]
+
+    def flipping_scenarios(self, l_idx, lower_tolerance):
+        return np.flatnonzero(self.link_failures(l_idx, lower_tolerance) & ~self.link_failures(l_idx, lower_tolerance + 1))
+
+    def occurrence_union(self, occurrence, other):
+        return occurrence | other
+
+    def occurrence_mask(self, occurrence):
+        return occurrence.reshape(self.shape[1:])
+
+    def occurrence_probability(self, occurrence, probability_matrix):
+        return probability_matrix.reshape(-1)[occurrence].sum()
+
+    def confidence_interval(self, occurrence, z=1.96):
+        # The estimate of the probability of the sampled scenarios in occurrence, and its normal confidence interval
+        values = self.likelihood_ratios * occurrence
+        estimate = (self.draws * values).sum() / self.n_samples
+        variance = max((self.draws * values ** 2).sum() - self.n_samples * estimate ** 2, 0.) / max(self.n_samples - 1, 1)
+        half_width = z * np.sqrt(variance / self.n_samples)
+        return estimate, max(estimate - half_width, 0.), estimate + half_width
+
+def estimate_probability_of_falling_apart(srlgs, network, sample, intensity_tolerance, z=1.96):
+    # (estimate, low, high) of the probability of falling apart from a ScenarioSample: a cut SRLG of srlgs occurs,
+    # or with srlgs=None, the failed links disconnect the network (checked by the cut oracle, once per failed link set)
+    network = compile_network(network, srlgs or ())
+    if srlgs is None:
+        oracle = CutOracle(network.network)
+        failed = np.stack([sample.link_failures(l, intensity_tolerance[l]) for l in range(len(network))])
+        signatures, inverse = np.unique(np.packbits(failed, axis=0).T, axis=0, return_inverse=True)
+        cut = np.array([oracle.is_cut_without(set(np.flatnonzero(np.unpackbits(signature, count=len(network))).tolist())) for signature in signatures], dtype=bool)
+        occurrence = cut[inverse.reshape(-1)] if len(signatures) else np.zeros(sample.shape[1], dtype=bool)
+    else:
+        occurrence = np.zeros(sample.shape[1], dtype=bool)
+        for srlg in srlgs:
+            occurrence |= get_SRLG_occurrence(srlg, network, sample, intensity_tolerance)
+    return sample.confidence_interval(occurrence, z)
 
 def countSRLGlinks(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix):
-    edges = list(network.edges)
-    partofSRLG = np.zeros(len(edges), dtype=float)
+    network = compile_network(network)
+    partofSRLG = np.zeros(len(network), dtype=float)
     for srlg in srlgs:
         srlg_probability = get_SRLG_probability(srlg, network, intensity_matrix, intensity_tolerance, probability_matrix)
-        for l in srlg:
-            partofSRLG[edges.index(l)] += srlg_probability
+        partofSRLG[network.srlg_indices(srlg)] += srlg_probability
     #return dict(zip(edges, partofSRLG))
     return partofSRLG
 
 def get_edge_to_improve_1(srlg, network, intensity_matrix, intensity_tolerance, probability_matrix):
-    edges = list(network.edges)
+    network = compile_network(network)
     partofSRLG = countSRLGlinks(srlg, network, intensity_matrix, intensity_tolerance, probability_matrix)
     partofSRLG = partofSRLG * (intensity_tolerance < 8.5)
+    # no upgradable link in an occurring SRLG
+    if partofSRLG.max() <= 0:
+        return None
     max_indexes = [i for i, j in enumerate(partofSRLG) if j == max(partofSRLG)]
     #print(max_indexes)
     if len(max_indexes) > 1:
         max_index = max_indexes[0]
-        min_length = network.edges[edges[max_index]]['length']
+        min_length = network.length[max_index]
         for idx in max_indexes:
-            length = network.edges[edges[idx]]['length']
+            length = network.length[idx]
             if length < min_length:
                 max_index = idx
                 min_length = length
@@ -233,42 +1190,243 @@ def get_edge_to_improve_1(srlg, network, intensity_matrix, intensity_tolerance,
     else:
         return max_indexes[0]
 
-def get_edge_to_improve_2(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold):
-    edges = list(network.edges)
-    probability_reduction_values = np.zeros(len(edges))
-    probability_of_falling_apart = get_probability_of_falling_apart(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix)
+class FallingApartEvaluator:
+    # Keeps the number of occurring SRLGs of every (p,m) scenario, so raising or lowering the tolerance of a link
+    # only re-evaluates the SRLGs containing that link, in the scenarios where that link flips.
+    # intensity_tolerance is modified in place by apply/revert.
+    def __init__(self, srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, count=None):
+        network = compile_network(network, srlgs)
+        self.intensity_matrix = intensity_matrix
+        self.intensity_tolerance = intensity_tolerance
+        self.probabilities = probability_matrix.reshape(-1)
+        self.srlgs = [network.srlg_indices(srlg) for srlg in srlgs]
+        self.link_srlgs = [[] for _ in range(len(network))]
+        for s_idx, srlg in enumerate(self.srlgs):
+            for l_idx in srlg:
+                self.link_srlgs[l_idx].append(s_idx)
+        if count is None:
+            count = np.zeros(len(self.probabilities), dtype=np.int32)
+            for srlg in self.srlgs:
+                srlg_occur = np.full(len(self.probabilities), fill_value=True, dtype=bool)
+                for l_idx in srlg:
+                    srlg_occur &= self.link_failures(l_idx, intensity_tolerance[l_idx])
+                count += srlg_occur
+        self.count = count
+        self.probability = self.probabilities[self.count > 0].sum()
+
+    def link_failures(self, l_idx, tolerance, scenarios=slice(None)):
+        if hasattr(self.intensity_matrix, 'scenario_failures'):
+            return self.intensity_matrix.scenario_failures(l_idx, tolerance, scenarios)
+        if hasattr(self.intensity_matrix, 'occurrence_mask'):
+            return get_link_failures(self.intensity_matrix, l_idx, tolerance).reshape(-1)[scenarios]
+        return self.intensity_matrix[l_idx].reshape(-1)[scenarios] > tolerance
+
+    def _flipping_scenarios(self, l_idx, lower_tolerance):
+        # scenarios failing the link at lower_tolerance but not at lower_tolerance + 1
+        if hasattr(self.intensity_matrix, 'flipping_scenarios'):
+            return self.intensity_matrix.flipping_scenarios(l_idx, lower_tolerance)
+        return np.flatnonzero(self.link_failures(l_idx, lower_tolerance) & ~self.link_failures(l_idx, lower_tolerance + 1))
+
+    def _occurring_srlgs(self, l_idx, scenarios):
+        # number of SRLGs containing the link that occur in the given scenarios while the link fails
+        occurring = np.zeros(len(scenarios), dtype=np.int32)
+        for s_idx in self.link_srlgs[l_idx]:
+            srlg_occur = np.full(len(scenarios), fill_value=True, dtype=bool)
+            for other in self.srlgs[s_idx]:
+                if other != l_idx:
+                    srlg_occur &= self.link_failures(other, self.intensity_tolerance[other], scenarios)
+            occurring += srlg_occur
+        return occurring
+
+    def probability_after_upgrade(self, l_idx):
+        scenarios = self._flipping_scenarios(l_idx, self.intensity_tolerance[l_idx])
+        occurring = self._occurring_srlgs(l_idx, scenarios)
+        saved = (occurring > 0) & (occurring == self.count[scenarios])
+        return self.probability - self.probabilities[scenarios[saved]].sum()
+
+    def apply(self, l_idx):
+        scenarios = self._flipping_scenarios(l_idx, self.intensity_tolerance[l_idx])
+        self.count[scenarios] -= self._occurring_srlgs(l_idx, scenarios)
+        self.intensity_tolerance[l_idx] += 1
+        self.probability = self.probabilities[self.count > 0].sum()
+
+    def revert(self, l_idx):
+        self.intensity_tolerance[l_idx] -= 1
+        scenarios = self._flipping_scenarios(l_idx, self.intensity_tolerance[l_idx])
+        self.count[scenarios] += self._occurring_srlgs(l_idx, scenarios)
+        self.probability = self.probabilities[self.count > 0].sum()
+
+# Parallel candidate scoring: the intensity matrix, the probabilities and the scenario counts of the evaluator
+# are shared with the workers read-only, each task only carries the current tolerance vector
+_candidate_worker = {}
+
+# What a worker gets instead of an array: a memory-mapped file by its path, or an array copied to shared memory.
+# An object holding arrays is pickled without them, and the worker puts them back.
+_MappedArray = namedtuple('_MappedArray', 'filename offset shape dtype order')
+_SharedArray = namedtuple('_SharedArray', 'name shape dtype')
+_SharedObject = namedtuple('_SharedObject', 'object arrays')
+
+def _share_array(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, shared
+
+def _attach_array(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _share(value, shms):
+    # The spec of value for the workers: a memory map of a whole file (np.load with mmap_mode) by its path, any other
+    # array in shared memory (appended to shms), and an object with array attributes (CriticalMagnitudeIndex,
+    # SparseIntensityMatrix, LinkFailureBitsets, ...) without them, its arrays shared the same way. The rest is pickled.
+    if isinstance(value, np.memmap) and isinstance(value.base, mmap.mmap) and value.filename:
+        order = 'F' if value.flags.f_contiguous and not value.flags.c_contiguous else 'C'
+        return _MappedArray(value.filename, value.offset, value.shape, value.dtype, order)
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        shm, shared = _share_array(np.asarray(value))
+        shms.append(shm)
+        return _SharedArray(shm.name, shared.shape, shared.dtype)
+    arrays = {name: attribute for name, attribute in getattr(value, '__dict__', {}).items()
+              if isinstance(attribute, np.ndarray) and not attribute.dtype.hasobject}
+    if arrays:
+        shell = copy.copy(value)
+        for name in arrays:
+            setattr(shell, name, None)
+        return _SharedObject(shell, {name: _share(array, shms) for name, array in arrays.items()})
+    return value
+
+def _attach(spec, shms):
+    # The value of a spec of _share in a worker, the shared memory it attaches is appended to shms
+    if isinstance(spec, _MappedArray):
+        return np.memmap(spec.filename, dtype=spec.dtype, mode='r', offset=spec.offset, shape=spec.shape, order=spec.order)
+    if isinstance(spec, _SharedArray):
+        shm, array = _attach_array(spec)
+        shms.append(shm)
+        return array
+    if isinstance(spec, _SharedObject):
+        for name, array in spec.arrays.items():
+            setattr(spec.object, name, _attach(array, shms))
+        return spec.object
+    return spec
+
+def _init_candidate_worker(srlgs, network, intensity_spec, probability_spec, count_spec):
+    shms = _candidate_worker['shms'] = []
+    intensity_matrix, probability_matrix, count = [_attach(spec, shms) for spec in (intensity_spec, probability_spec, count_spec)]
+    _candidate_worker['evaluator'] = FallingApartEvaluator(srlgs, network, intensity_matrix, None, probability_matrix, count)
+
+def _score_candidates(args):
+    intensity_tolerance, probability, candidates = args
+    evaluator = _candidate_worker['evaluator']
+    evaluator.intensity_tolerance = intensity_tolerance
+    evaluator.probability = probability
+    return [evaluator.probability_after_upgrade(idx) for idx in candidates]
+
+class CandidateScoringPool:
+    # Process pool computing FallingApartEvaluator.probability_after_upgrade for many candidate links at once.
+    # The workers get the intensity and probability matrices through _share: a memory-mapped cube is reopened from its
+    # file, other arrays and the arrays of an index (CriticalMagnitudeIndex, SparseIntensityMatrix, LinkFailureBitsets)
+    # are copied to shared memory once, nothing large is pickled per worker.
+    # The evaluator's count array is moved to shared memory, so apply/revert in the parent are seen by the workers.
+    def __init__(self, processes, srlgs, network, intensity_matrix, probability_matrix, evaluator):
+        self.processes = processes or mp.cpu_count()
+        self.evaluator = evaluator
+        self.shms = []
+        intensity_spec, probability_spec = _share(intensity_matrix, self.shms), _share(probability_matrix, self.shms)
+        shm, evaluator.count = _share_array(evaluator.count)
+        self.shms.append(shm)
+        count_spec = _SharedArray(shm.name, evaluator.count.shape, evaluator.count.dtype)
+        self.pool = mp.Pool(self.processes, _init_candidate_worker, (srlgs, network, intensity_spec, probability_spec, count_spec))
+
+    def probabilities_after_upgrade(self, candidates):
+        chunks = [chunk for chunk in np.array_split(np.asarray(candidates, dtype=int), self.processes) if len(chunk)]
+        tolerance = np.array(self.evaluator.intensity_tolerance)
+        results = self.pool.map(_score_candidates, [(tolerance, self.evaluator.probability, chunk) for chunk in chunks])
+        return [p for chunk in results for p in chunk]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.evaluator.count = self.evaluator.count.copy()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def get_edge_to_improve_2(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold, evaluator=None, pool=None):
+    network = compile_network(network, srlgs)
+    if evaluator is None:
+        evaluator = FallingApartEvaluator(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix)
+    probability_reduction_values = np.zeros(len(network))
+    probability_of_falling_apart = evaluator.probability
+
+    candidates = [idx for idx in range(len(network)) if intensity_tolerance[idx] < 8.5]
+    if pool is not None:
+        decreased_probabilities = dict(zip(candidates, pool.probabilities_after_upgrade(candidates)))
+    else:
+        decreased_probabilities = {idx: evaluator.probability_after_upgrade(idx) for idx in candidates}
     
-    for idx, edge in enumerate(edges):
+    for idx in range(len(network)):
         probability_reduction = 0
-        if intensity_tolerance[idx] < 8.5:
-            intensity_tolerance[idx] += 1
-            decreased_probability_of_falling_apart = get_probability_of_falling_apart(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix)
-            probability_reduction = probability_of_falling_apart - max(threshold, decreased_probability_of_falling_apart)
-            intensity_tolerance[idx] -= 1
-        probability_reduction_values[idx] = probability_reduction / network.edges[edge]['length']
+        if idx in decreased_probabilities:
+            probability_reduction = probability_of_falling_apart - max(threshold, decreased_probabilities[idx])
+        probability_reduction_values[idx] = probability_reduction / network.length[idx]
     
+    # no candidate left, or none of them reduces the probability
+    if probability_reduction_values.max() <= 0:
+        return None
     return np.argmax(probability_reduction_values)
 
-def heuristic(version, srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold):
-    active_srlgs = srlgs.copy()
-    edges = list(network.edges)
+def _upgrade_until(version, srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold, evaluator, pool=None, max_tolerance=None):
+    # Upgrades the best link of the version until the evaluator's probability is at most threshold, returns the cost.
+    # INF when no link improves the probability any more, or when the best link is at its max_tolerance.
     cost = 0
-    
-    probability_of_falling_apart = get_probability_of_falling_apart(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix)
-    #print(f'{probability_of_falling_apart:.5f}')
-    
-    while probability_of_falling_apart > threshold:
+    while evaluator.probability > threshold:
         if version == 1:
-            edge_to_improve = get_edge_to_improve_1(active_srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix)
+            edge_to_improve = get_edge_to_improve_1(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix)
         else:
-            edge_to_improve = get_edge_to_improve_2(active_srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold)
-        cost += network.edges[edges[edge_to_improve]]['length']
+            edge_to_improve = get_edge_to_improve_2(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold, evaluator, pool)
+        if edge_to_improve is None or (max_tolerance is not None and intensity_tolerance[edge_to_improve] + 1 > max_tolerance[edge_to_improve]):
+            return np.inf
+        cost += network.length[edge_to_improve]
         #print(edge_to_improve)
-        intensity_tolerance[edge_to_improve] += 1
-        probability_of_falling_apart = get_probability_of_falling_apart(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix)
-        #print(f'{probability_of_falling_apart:.5f}')
-        #print(intensity_tolerance)
-        
+        evaluator.apply(edge_to_improve)
+        count('heuristic_iterations')
+        #print(f'{evaluator.probability:.5f}')
+    return cost
+
+def heuristic(version, srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold, processes=None, sample=None, max_tolerance=None):
+    # processes > 1 scores the candidate edges of version 2 in a process pool.
+    # sample: a ScenarioSample ranking the candidates on the sampled scenarios until the estimate meets the threshold,
+    # then the exact probability confirms it (and the exact ranking continues if it does not).
+    # max_tolerance: the highest tolerance of every link, the cost is INF if the heuristic would upgrade a link past it
+    # (or if the threshold cannot be met at all).
+    active_srlgs = srlgs.copy()
+    network = compile_network(network, srlgs)
+    cost = 0
+
+    with span(f'H{version}', threshold=threshold, processes=processes, sampled=sample is not None):
+        if sample is not None:
+            with span('sampled_ranking'):
+                estimator = FallingApartEvaluator(srlgs, network, sample, intensity_tolerance, sample.weights)
+                cost += _upgrade_until(version, active_srlgs, network, sample, intensity_tolerance, sample.weights, threshold, estimator, max_tolerance=max_tolerance)
+                annotate(cost=float(cost), estimate=float(estimator.probability))
+
+        evaluator = FallingApartEvaluator(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix)
+        #print(f'{evaluator.probability:.5f}')
+        parallel = version != 1 and processes is not None and processes > 1 and evaluator.probability > threshold and cost < np.inf
+        with CandidateScoringPool(processes, active_srlgs, network, intensity_matrix, probability_matrix, evaluator) if parallel else nullcontext() as pool:
+            if cost < np.inf:
+                cost += _upgrade_until(version, active_srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold, evaluator, pool, max_tolerance)
+        probability_of_falling_apart = evaluator.probability
+        annotate(cost=float(cost), probability=float(probability_of_falling_apart))
+
     print(f'H{version} Cost: {cost:.0f}')
     return intensity_tolerance, cost
 
@@ -278,11 +1436,9 @@ def heuristic(version, srlgs, network, intensity_matrix, intensity_tolerance, pr
 # # Old Heuristic 1 & 2
 
 def get_SRLG_probability_matrix(srlg, network, intensity_matrix, intensity_tolerance, probability_matrix):
-    edges = list(network.edges)
-    srlg_occur = np.full(intensity_matrix.shape[1:], fill_value=True, dtype=bool)
-    for l in srlg:
-        l_idx = edges.index(l)
-        srlg_occur &= intensity_matrix[l_idx] > intensity_tolerance[l_idx]
+    srlg_occur = get_SRLG_occurrence(srlg, network, intensity_matrix, intensity_tolerance)
+    if hasattr(intensity_matrix, 'occurrence_mask'):
+        srlg_occur = intensity_matrix.occurrence_mask(srlg_occur)
     return probability_matrix[srlg_occur]
 
 # def remove_improbable_SRLGs(srlgs, network, intensity_matrix, intensity_tolerance, probability_matrix, threshold):
@@ -0,0 +1,142 @@
+import argparse
+import json
+import tempfile
+import tracemalloc
+from ilp_model import *
+from instrumentation import configure, peak_rss_MB
+
+# Wall time and peak memory of the FRADIR pipeline stages on the bundled networks
+#   python benchmark.py                                  all bundled networks
+#   python benchmark.py italy_995 --json bench.json      save the results
+#   python benchmark.py --baseline bench.json            compare with saved results, exit 1 on a regression
+# Networks without a bundled earthquake grid (and every network with --synthetic) get a synthetic grid,
+# so nothing depends on the intensities/ cache. Every run also checks the batched distances against the scalar path.
+
+# network: (PSRLG log, cut SRLGs, earthquake grid, attenuation model)
+NETWORKS = {
+    'italy_995': ('PSRLGs/italy_995.xml', 'min_cut_SRLGs/italy_995_2-4', 'earthquake_probabilities/italy_ds16.csv', 'europe'),
+    'usa_995': ('PSRLGs/usa_995.xml', 'min_cut_SRLGs/usa_995', 'earthquake_probabilities/usa_ds23.csv', 'usa'),
+    'germany': ('PSRLGs/germany.xml', 'min_cut_SRLGs/germany_6e-5', None, 'europe'),
+    'cost266': ('PSRLGs/cost266.xml', 'min_cut_SRLGs/cost266_2e-7', None, 'europe'),
+}
+
+
+# Synthetic inputs
+def synthetic_earthquake_grid(network, epicenters=2000, magnitudes=np.round(np.arange(4.6, 8.5, 0.1), 1), b_value=1., seed=0):
+    # Random epicenters over the bounding box of the network (padded by a degree) with random activity rates, and
+    # Gutenberg-Richter magnitudes; the [P,M] probabilities sum to 1 like the bundled grids
+    rng = np.random.default_rng(seed)
+    points = np.array([(p['Longitude'], p['Latitude']) for e in network.edges for p in network.edges[e]['points']['point']])
+    low, high = points.min(axis=0) - 1, points.max(axis=0) + 1
+    epicenter_points = rng.uniform(low, high, size=(epicenters, 2))
+    activity = rng.gamma(0.5, size=epicenters)
+    prob_matrix = activity[:, None] * 10 ** (-b_value * (magnitudes - magnitudes[0]))[None, :]
+    return epicenter_points, magnitudes, prob_matrix / prob_matrix.sum()
+
+def synthetic_intensity_matrix(network, epicenters=2000, attenuation='europe', seed=0):
+    # Intensity cube and probability matrix of a synthetic earthquake grid
+    epicenter_points, magnitudes, prob_matrix = synthetic_earthquake_grid(network, epicenters, seed=seed)
+    intensity = build_intensity_matrix(network, epicenter_points, magnitudes, ATTENUATION_MODELS[attenuation])
+    return intensity, prob_matrix
+
+
+# Measurement
+def measure(stage, repeat=1, trace_memory=True):
+    # Best wall time of repeat calls, then the peak of the traced (python and numpy) allocations of one more call
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = stage()
+        times.append(time.perf_counter() - start)
+    peak = float('nan')
+    if trace_memory:
+        tracemalloc.start()
+        stage()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, min(times), peak
+
+def run_network(network_name, synthetic=False, epicenters=2000, threshold=0.001, repeat=1, trace_memory=True, samples=20000):
+    PSRLG_file, cut_file, probability_file, attenuation = NETWORKS[network_name]
+    network_file = f'networks/{network_name}.gml'
+    g = nx.read_gml(network_file, label='id')
+    records = []
+
+    def run(stage_name, stage):
+        result, wall, peak = measure(stage, repeat, trace_memory)
+        records.append({'network': network_name, 'stage': stage_name, 'wall_s': wall, 'peak_MB': peak,
+                        'rss_MB': peak_rss_MB()})
+        print(f'{network_name:>10} {stage_name:>14} {wall:10.3f} s {peak:10.1f} MB')
+        return result
+
+    run('parse_SRLGs', lambda: get_SRLGs(PSRLG_file))
+    run('cut_SRLGs', lambda: get_minimal_cut_SRLGs(PSRLG_file, g))
+    with open(cut_file, 'rb') as fp:
+        cut_srlgs = pickle.load(fp)
+
+    if synthetic or probability_file is None:
+        epicenter_points = synthetic_earthquake_grid(g, epicenters)[0]
+        intensity, prob_matrix = run('intensity', lambda: synthetic_intensity_matrix(g, epicenters, attenuation))
+    else:
+        epicenter_points, magnitudes, prob_matrix = read_earthquake_probabilities(probability_file)
+        intensity = run('intensity', lambda: build_intensity_matrix(g, epicenter_points, magnitudes, ATTENUATION_MODELS[attenuation]))
+        run('intensity_sparse', lambda: build_sparse_intensity_matrix(g, epicenter_points, magnitudes, ATTENUATION_MODELS[attenuation]))
+
+    # the batched distances of the intensity stages against the scalar SVector path (raises above 1e-6 km)
+    print(f'{network_name:>10} {"distance_check":>14} max difference {check_distance_matrix(g, epicenter_points):.2e} km')
+
+    network = compile_network(g, cut_srlgs)
+    H = np.full(len(network), 6)
+    run('falling_apart', lambda: get_probability_of_falling_apart(cut_srlgs, network, intensity, H, prob_matrix))
+    run('H1', lambda: heuristic(1, cut_srlgs, network, intensity, H.copy(), prob_matrix, threshold))
+    run('H2', lambda: heuristic(2, cut_srlgs, network, intensity, H.copy(), prob_matrix, threshold))
+    run('H2_sampled', lambda: heuristic(2, cut_srlgs, network, intensity, H.copy(), prob_matrix, threshold, sample=ScenarioSample(intensity, prob_matrix, samples)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run('ILP_build', lambda: write_model_lp(os.path.join(tmp_dir, 'model.lp'), network, cut_srlgs, intensity, prob_matrix, H, ub=3, TFA=threshold))
+    return records
+
+def compare(records, baseline_records, tolerance):
+    # Stages slower than tolerance times the baseline
+    baseline = {(r['network'], r['stage']): r for r in baseline_records}
+    regressions = []
+    for r in records:
+        base = baseline.get((r['network'], r['stage']))
+        if base is None:
+            continue
+        ratio = r['wall_s'] / base['wall_s'] if base['wall_s'] > 0 else 1.
+        flag = '  <-- regression' if ratio > tolerance else ''
+        print(f"{r['network']:>10} {r['stage']:>14} {base['wall_s']:10.3f} s -> {r['wall_s']:10.3f} s ({ratio:5.2f}x){flag}")
+        if flag:
+            regressions.append(r)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the FRADIR pipeline stages')
+    parser.add_argument('networks', nargs='*', help=f'networks to benchmark, all of {sorted(NETWORKS)} by default')
+    parser.add_argument('--synthetic', action='store_true', help='use a synthetic earthquake grid for every network')
+    parser.add_argument('--epicenters', type=int, default=2000, help='number of epicenters of the synthetic grids')
+    parser.add_argument('--threshold', type=float, default=0.001, help='threshold of the heuristics')
+    parser.add_argument('--samples', type=int, default=20000, help='sampled scenarios of the sampled heuristic')
+    parser.add_argument('--repeat', type=int, default=1, help='number of timed runs per stage, the best is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the extra traced run of every stage')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='slowdown counted as a regression')
+    args = parser.parse_args()
+    for network_name in args.networks:
+        if network_name not in NETWORKS:
+            parser.error(f'unknown network {network_name}, choose from {sorted(NETWORKS)}')
+
+    configure(progress=False)  # no progress bars inside the timed stages
+    records = []
+    for network_name in args.networks or sorted(NETWORKS):
+        records += run_network(network_name, args.synthetic, args.epicenters, args.threshold, args.repeat, not args.no_memory, args.samples)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(records, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(records, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit(1)
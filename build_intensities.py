@@ -0,0 +1,23 @@
+import argparse
+from backend import *
+
+# Builds (or finds in the cache) the [L,P,M] intensity matrix of a network for an earthquake probability grid
+#   python build_intensities.py networks/italy_995.gml earthquake_probabilities/italy_ds16.csv --attenuation europe
+#   python build_intensities.py ... --sparse 6 --quantized     the epicenters which can exceed intensity 6 per link
+
+parser = argparse.ArgumentParser(description='Build the cached intensity matrix of a network')
+parser.add_argument('network', help='GML file of the network')
+parser.add_argument('probabilities', help='CSV file of the earthquake probabilities (Long, Lat, magnitudes...)')
+parser.add_argument('--attenuation', choices=sorted(ATTENUATION_MODELS), default='europe')
+parser.add_argument('--cache-dir', default='intensities')
+parser.add_argument('--magnitude-chunk', type=int, default=8, help='number of magnitudes computed at once')
+parser.add_argument('--quantized', action='store_true', help='also write the uint8 ceil(intensity) cube')
+parser.add_argument('--sparse', type=int, metavar='TOLERANCE', help='only the epicenters within the cutoff radius at this tolerance')
+args = parser.parse_args()
+
+if args.sparse is not None:
+    intensity = get_sparse_intensity_matrix(args.network, args.probabilities, args.attenuation, args.sparse, args.cache_dir, args.quantized)
+    print(f'{intensity.shape} {intensity.dtype}: {intensity.density:.1%} of the (link, epicenter) pairs, {intensity.nbytes / 2**20:.1f} MB')
+else:
+    intensity = get_intensity_matrix(args.network, args.probabilities, args.attenuation, args.cache_dir, args.magnitude_chunk, mmap_mode='r', quantized=args.quantized)
+    print(f'{intensity.filename}: {intensity.shape} {intensity.dtype}')
@@ -0,0 +1,21 @@
+import argparse
+from backend import *
+
+# Converts float64 [L,P,M] intensity cubes to the uint8 ceil(intensity) format, which gives the same link failures
+# for integer tolerances and can be opened with mmap_mode='r'
+#   python convert_intensities.py intensities/italy_995_italy_ds16_europe_*.npy
+
+parser = argparse.ArgumentParser(description='Convert intensity matrices to the uint8 format')
+parser.add_argument('npy_files', nargs='+', help='float .npy intensity matrices')
+parser.add_argument('--check', action='store_true', help='compare the link failures of the two cubes for tolerances 6..11')
+args = parser.parse_args()
+
+for npy_file in args.npy_files:
+    if np.load(npy_file, mmap_mode='r').dtype == np.uint8:
+        print(f'{npy_file}: already uint8')
+        continue
+    out_file = convert_intensity_matrix(npy_file)
+    print(f'{npy_file} -> {out_file}: {os.path.getsize(npy_file) >> 20} MB -> {os.path.getsize(out_file) >> 20} MB')
+    if args.check:
+        intensity, quantized = np.load(npy_file, mmap_mode='r'), np.load(out_file, mmap_mode='r')
+        assert all(np.array_equal(intensity[l] > t, quantized[l] > t) for l in range(len(intensity)) for t in range(6, 12))
@@ -0,0 +1,59 @@
+import argparse
+from ilp_model import *
+from instrumentation import configure
+
+# Builds (or finds in the model cache) and solves the FRADIR ILP of every network and spine bonus for the given TFAs
+#   python fradir_model.py italy_995 usa_995 --spine-bonus 0 1 --tfa 0.01 0.005 0.001
+#   python fradir_model.py italy_995 --build-only
+#   python fradir_model.py italy_995 --lazy       row generation, the disconnecting scenarios are found by the solver callback
+#   python fradir_model.py italy_995 --heuristic-start        H1/H2 solutions as MIP starts, cutoffs and upgrade bounds
+#   python fradir_model.py italy_995 usa_99 --compare-starts  the cold start against the heuristic start
+# Writes results/{network}/ilp_{network}_SB{spine_bonus}.csv (cost, runtime and status per TFA)
+# and results/{network}/ilp_upgrades_{network}_SB{spine_bonus}.csv (Delta H of every link per TFA),
+# or results/{network}/start_comparison_{network}_SB{spine_bonus}.csv with --compare-starts.
+
+TFAS = [0.01, 0.009, 0.008, 0.007, 0.006, 0.005, 0.004, 0.003, 0.002, 0.001, 0.0009, 0.0008, 0.0007, 0.0006, 0.0005]
+
+parser = argparse.ArgumentParser(description='Build and solve FRADIR models')
+parser.add_argument('networks', nargs='+', help=f'network names, with bundled inputs for {sorted(FRADIR_INPUTS)}')
+parser.add_argument('--spine-bonus', type=int, nargs='+', default=[0])
+parser.add_argument('--tfa', type=float, nargs='+', default=TFAS)
+parser.add_argument('--hnull', type=int, default=6, help='intensity tolerance of the links before the upgrade')
+parser.add_argument('--ub', type=int, help='maximal upgrade of a link (default: per network, 3 otherwise)')
+parser.add_argument('--cut-file', help='cut SRLGs (default: per network)')
+parser.add_argument('--probability-file', help='earthquake probabilities (default: per network)')
+parser.add_argument('--attenuation', choices=sorted(ATTENUATION_MODELS), help='attenuation model (default: per network)')
+parser.add_argument('--solver', default=GRB, help=f'{GRB} or {CBC}, {CBC} is used when {GRB} is not available')
+parser.add_argument('--cache-dir', default='models')
+parser.add_argument('--max-seconds', type=float, default=INF, help='time limit of every solve')
+parser.add_argument('--build-only', action='store_true', help='only build the models into the cache')
+parser.add_argument('--sparse', action='store_true', help='only the epicenters within the cutoff radius of every link')
+parser.add_argument('--lazy', action='store_true', help='add the cut SRLG rows at the incumbents instead of up front')
+parser.add_argument('--heuristic-start', action='store_true', help='start from the cheaper of H1 and H2 at every TFA')
+parser.add_argument('--compare-starts', action='store_true', help='time to the first good solution and runtime, cold against heuristic start')
+parser.add_argument('--processes', type=int, help='processes scoring the H2 candidates')
+parser.add_argument('--trace', help='JSON lines file of the stage timings')
+args = parser.parse_args()
+
+configure(trace=args.trace, echo=True)
+for network_name in args.networks:
+    g, cut_srlgs, intensity, prob_matrix = load_fradir_inputs(network_name, args.cut_file, args.probability_file, args.attenuation, args.hnull if args.sparse else None)
+    ub = args.ub or FRADIR_INPUTS.get(network_name, {}).get('ub', 3)
+    for spine_bonus in args.spine_bonus:
+        model, deltaH, tfa_constr = build_fradir_model(g, cut_srlgs, intensity, prob_matrix, args.hnull, spine_bonus, ub, max(args.tfa), args.solver, args.cache_dir, args.lazy)
+        if args.build_only:
+            continue
+        os.makedirs(f'results/{network_name}', exist_ok=True)
+        if args.compare_starts:
+            comparison = compare_starts(g, cut_srlgs, intensity, prob_matrix, args.tfa, args.hnull, spine_bonus, ub, args.solver, args.cache_dir, args.lazy, args.max_seconds, args.processes)
+            print(f'{network_name} SB{spine_bonus}\n{comparison}')
+            comparison.to_csv(f'results/{network_name}/start_comparison_{network_name}_SB{spine_bonus}.csv', index=False, float_format='%.4f')
+            continue
+        heuristic_start = None
+        if args.heuristic_start:
+            H = get_initial_tolerances(compile_network(g, cut_srlgs), args.hnull, spine_bonus)
+            heuristic_start = HeuristicStart(model, deltaH, g, cut_srlgs, intensity, prob_matrix, H, processes=args.processes)
+        results, upgrades = sweep_TFA(model, deltaH, tfa_constr, g, args.tfa, max_seconds=args.max_seconds, heuristic_start=heuristic_start)
+        print(f'{network_name} SB{spine_bonus}\n{results}')
+        results.to_csv(f'results/{network_name}/ilp_{network_name}_SB{spine_bonus}.csv', index=False, float_format='%.4f')
+        upgrades.to_csv(f'results/{network_name}/ilp_upgrades_{network_name}_SB{spine_bonus}.csv', index=False, float_format='%.4f')
@@ -0,0 +1,723 @@
+from mip import *
+from backend import *
+from instrumentation import span, count, annotate, peak_rss_MB
+from itertools import product
+import tempfile
+import hashlib
+import inspect
+import resource
+import time
+
+
+# The FRADIR ILP
+#   deltaH[l]:  upgrade of the intensity tolerance of link l
+#   Y[l][p][m]: link l fails in scenario (p,m)
+#   Z[c][p][m]: every link of cut SRLG c fails in scenario (p,m)
+#   W[p][m]:    the network falls apart in scenario (p,m)
+# Presolve
+def get_failure_levels(intensity, H, ub, links=None):
+    # [L, P*M] number of upgrades dH in 0..ub at which the link still fails in the scenario (intensity > H + dH),
+    # 0: never fails, ub+1: fails whatever the upgrade
+    L = intensity.shape[0]
+    levels = np.zeros((L, int(np.prod(intensity.shape[1:]))), dtype=np.uint8)
+    sparse = isinstance(intensity, SparseIntensityMatrix)
+    for l in (range(L) if links is None else links):
+        if sparse:
+            # only the epicenters within the cutoff radius can fail the link
+            if H[l] < intensity.tolerance:
+                raise ValueError(f'Tolerance {H[l]} of link {l} below the tolerance {intensity.tolerance} of the sparse intensity matrix')
+            epicenters, link_intensity = intensity.link(l)
+            link_levels = levels[l].reshape(intensity.shape[1:])
+            for d in range(ub + 1):
+                link_levels[epicenters] += link_intensity > H[l] + d
+            continue
+        link_intensity = np.asarray(intensity[l]).reshape(-1)
+        for d in range(ub + 1):
+            levels[l] += link_intensity > H[l] + d
+    return levels
+
+def presolve_scenarios(network, cut_srlgs, intensity, prob_matrix, H, ub):
+    # Drops the (p,m) scenarios in which no cut SRLG can occur at any upgrade level, and merges the scenarios
+    # with identical failure levels on every link of the cut SRLGs, summing their probabilities.
+    # Returns the [L,Q] failure levels and the [Q] probabilities of the remaining scenarios,
+    # and the scenario of every remaining (p,m) (-1 if dropped).
+    network = compile_network(network, cut_srlgs)
+    srlg_links = [network.srlg_indices(s) for s in cut_srlgs]
+    cut_links = sorted(set(l for s in srlg_links for l in s))
+    levels = get_failure_levels(intensity, H, ub, cut_links)
+
+    possible = np.zeros(levels.shape[1], dtype=bool)
+    for s in srlg_links:
+        possible |= (levels[s] > 0).all(axis=0)
+    columns = np.flatnonzero(possible)
+
+    scenario_levels, inverse = np.unique(levels[:, columns], axis=1, return_inverse=True)
+    scenario_probabilities = np.bincount(inverse.reshape(-1), weights=prob_matrix.reshape(-1)[columns], minlength=scenario_levels.shape[1])
+    scenario_of = np.full(levels.shape[1], -1)
+    scenario_of[columns] = inverse.reshape(-1)
+    return scenario_levels, scenario_probabilities, scenario_of.reshape(prob_matrix.shape)
+
+def build_model(network, cut_srlgs, intensity, prob_matrix, H, ub=3, TFA=1., solver_name=GRB, presolve=True, bulk=True):
+    # bulk: the presolved model is written with write_model_lp and loaded by the solver, instead of built with add_constr
+    with span('build_model', presolve=presolve, bulk=bulk, solver=solver_name):
+        if presolve and bulk:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                lp_file = os.path.join(tmp_dir, 'fradir.lp')
+                write_model_lp(lp_file, network, cut_srlgs, intensity, prob_matrix, H, ub, TFA)
+                with span('read_model'):
+                    return read_model(lp_file, network.number_of_edges(), solver_name)
+        if presolve:
+            return build_presolved_model(network, cut_srlgs, intensity, prob_matrix, H, ub, TFA, solver_name)
+        return build_full_model(network, cut_srlgs, intensity, prob_matrix, H, ub, TFA, solver_name)
+
+def build_full_model(network, cut_srlgs, intensity, prob_matrix, H, ub=3, TFA=1., solver_name=GRB):
+    # The original Y/Z/W model over every (p,m) scenario
+    network = compile_network(network, cut_srlgs)
+    L, P, M = intensity.shape
+    links, epicenters, magnitudes = range(L), range(P), range(M)
+    S = len(cut_srlgs)
+
+    model = Model(sense=MINIMIZE, solver_name=solver_name)
+
+    #Variables
+    deltaH = [model.add_var(var_type=INTEGER, lb=0, ub=ub) for l in links]
+    Z = [[[model.add_var(var_type=BINARY) for k in magnitudes] for j in epicenters] for i in range(S)]
+    Y = [[[model.add_var(var_type=BINARY) for k in magnitudes] for j in epicenters] for i in links]
+    W = [[model.add_var(var_type=BINARY) for k in magnitudes] for j in epicenters]
+
+    #Objective Function
+    model.objective = xsum( network.length[link_idx] * deltaH[link_idx] for link_idx in links )
+
+    #Constraint 1
+    for l,p,m in product(*[links, epicenters, magnitudes]):
+        model.add_constr( Y[l][p][m] >= 1 - ((H[l] + deltaH[l]) / intensity[l,p,m]) )
+
+    #Constraint 2
+    for (c,s), p, m in product(*[enumerate(cut_srlgs), epicenters, magnitudes]):
+        model.add_constr( Z[c][p][m] >= (xsum(Y[l][p][m] for l in network.srlg_indices(s)) - len(s) + 1) )
+
+    #Constraint 3
+    for (c,s), p, m in product(*[enumerate(cut_srlgs), epicenters, magnitudes]):
+        model.add_constr( W[p][m] >= Z[c][p][m] )
+
+    #Constraint 4, the only one depending on the TFA
+    tfa_constr = model.add_constr(xsum( W[p][m] * prob_matrix[p,m] for p,m in product(epicenters,magnitudes) ) <= TFA )
+
+    count('variables', model.num_cols)
+    count('constraints', model.num_rows)
+    return model, deltaH, tfa_constr
+
+
+def build_presolved_model(network, cut_srlgs, intensity, prob_matrix, H, ub=3, TFA=1., solver_name=GRB):
+    # The same model over the presolved scenarios q. With k = failure level of link l in q,
+    # Y[l,q] >= 1 - (H+deltaH)/intensity becomes k*Y[l,q] + deltaH[l] >= k, and Y is only a variable for 0 < k <= ub,
+    # for k = 0 the link never fails and for k = ub+1 it always fails.
+    # Without a scenario of positive probability there is no TFA row (None is returned), deltaH = 0 is optimal.
+    network = compile_network(network, cut_srlgs)
+    L = len(network)
+    scenario_levels, scenario_probabilities, _ = presolve_scenarios(network, cut_srlgs, intensity, prob_matrix, H, ub)
+    Q = len(scenario_probabilities)
+
+    model = Model(sense=MINIMIZE, solver_name=solver_name)
+
+    #Variables
+    deltaH = [model.add_var(var_type=INTEGER, lb=0, ub=ub) for l in range(L)]
+    if not scenario_probabilities.any():
+        model.objective = xsum( network.length[l] * deltaH[l] for l in range(L) )
+        annotate(scenarios=Q)
+        count('variables', model.num_cols)
+        return model, deltaH, None
+
+    Y = {(l,q): model.add_var(var_type=BINARY) for l,q in zip(*np.nonzero((scenario_levels > 0) & (scenario_levels <= ub)))}
+    W = [model.add_var(var_type=BINARY) for q in range(Q)]
+
+    #Objective Function
+    model.objective = xsum( network.length[l] * deltaH[l] for l in range(L) )
+
+    #Constraint 1
+    for (l,q), y in Y.items():
+        k = int(scenario_levels[l,q])
+        model.add_constr( k * y + deltaH[l] >= k )
+
+    #Constraint 2 & 3, the SRLGs failing whatever the upgrade force W, the ones which cannot fail are left out
+    for s in cut_srlgs:
+        s = network.srlg_indices(s)
+        for q in np.flatnonzero((scenario_levels[s] > 0).all(axis=0)):
+            y = [Y[l,q] for l in s if (l,q) in Y]
+            if y:
+                z = model.add_var(var_type=BINARY)
+                model.add_constr( z >= xsum(y) - len(y) + 1 )
+                model.add_constr( W[q] >= z )
+            else:
+                W[q].lb = 1
+
+    #Constraint 4, the only one depending on the TFA
+    tfa_constr = model.add_constr(xsum( W[q] * scenario_probabilities[q] for q in range(Q) ) <= TFA )
+
+    annotate(scenarios=Q)
+    count('variables', model.num_cols)
+    count('constraints', model.num_rows)
+    return model, deltaH, tfa_constr
+
+
+# Row generation
+def presolve_connectivity_scenarios(network, intensity, prob_matrix, H, ub, oracle=None):
+    # Like presolve_scenarios, without a cut SRLG list: drops the scenarios in which the network stays connected even
+    # when every link that can fail at some upgrade level fails, and merges the scenarios with identical failure levels
+    # on every link. Returns the [L,Q] failure levels, the [Q] probabilities and whether the links failing whatever
+    # the upgrade already disconnect the network in q.
+    network = compile_network(network)
+    oracle = oracle or CutOracle(network.network)
+    levels = get_failure_levels(intensity, H, ub)
+    columns = np.flatnonzero((levels > 0).any(axis=0))
+    scenario_levels, inverse = np.unique(levels[:, columns], axis=1, return_inverse=True)
+    scenario_probabilities = np.bincount(inverse.reshape(-1), weights=prob_matrix.reshape(-1)[columns], minlength=scenario_levels.shape[1])
+
+    possible = np.array([oracle.is_cut_without(set(np.flatnonzero(k > 0).tolist())) for k in scenario_levels.T], dtype=bool)
+    scenario_levels, scenario_probabilities = scenario_levels[:, possible], scenario_probabilities[possible]
+    forced = np.array([oracle.is_cut_without(set(np.flatnonzero(k > ub).tolist())) for k in scenario_levels.T], dtype=bool)
+    return scenario_levels, scenario_probabilities, forced.reshape(-1)
+
+class CutRowGenerator(ConstrsGenerator):
+    # Lazy constraints of the row generation model. At a solution the links failing in scenario q are the ones with
+    # Y[l,q] = 1 (or failure level ub+1); when they disconnect the network while W[q] = 0, a minimal cut c among them
+    # gives the violated row W[q] >= sum(Y[l,q] for l in c) - |c| + 1. The rows are valid for every upgrade, so they
+    # are also separated at the fractional solutions, rounding Y, when violated there. The cuts found so far are tried
+    # first, new ones are shrunk from the failed link set with the cut oracle and kept for the next solutions.
+    def __init__(self, oracle, scenario_levels, ub, deltaH, Y, W):
+        self.oracle = oracle
+        self.scenario_levels = scenario_levels
+        self.ub = ub
+        self.deltaH, self.Y, self.W = deltaH, list(Y.values()), W
+        self.Y_position = {key: i for i, key in enumerate(Y)}
+        self.Y_links = np.array([l for l, _ in Y], dtype=int)
+        self.Y_scenarios = np.array([q for _, q in Y], dtype=int)
+        self.cuts = []
+        self.rows = set()
+        self._minimal_cuts = {}
+
+    def add_cut(self, links):
+        links = np.asarray(sorted(links), dtype=int)
+        if not any(np.array_equal(links, c) for c in self.cuts):
+            self.cuts.append(links)
+        return links
+
+    def minimal_cut(self, failed):
+        # Drops the failed links one by one as long as the rest still disconnects the network; a link kept once
+        # stays necessary for the smaller sets, so a single pass gives a minimal cut
+        cut = set(failed)
+        for l in sorted(failed):
+            if self.oracle.is_cut_without(cut - {l}):
+                cut.discard(l)
+        count('lazy_cuts_found')
+        return self.add_cut(cut)
+
+    def violated_rows(self, y, w):
+        # (cut, q) of the rows violated by the [L,Q] Y values y (1 for the links failing whatever the upgrade)
+        # and the [Q] W values w
+        fails = y > 0.5
+        candidates = (w < 0.5) & fails.any(axis=0)
+        rows = []
+        for c in self.cuts:
+            covered = candidates & fails[c].all(axis=0)
+            rows += [(c, q) for q in np.flatnonzero(covered)]
+            candidates &= ~covered
+        for q in np.flatnonzero(candidates):
+            key = np.packbits(fails[:, q]).tobytes()
+            if key not in self._minimal_cuts:
+                failed = set(np.flatnonzero(fails[:, q]).tolist())
+                self._minimal_cuts[key] = self.minimal_cut(failed) if self.oracle.is_cut_without(failed) else None
+            if self._minimal_cuts[key] is not None:
+                rows.append((self._minimal_cuts[key], q))
+        return [(c, q) for c, q in rows if y[c, q].sum() - len(c) + 1 - w[q] > 1e-6]
+
+    def values(self, Y, W):
+        y = (self.scenario_levels > self.ub).astype(float)
+        y[self.Y_links, self.Y_scenarios] = [v.x for v in Y]
+        return y, np.array([v.x for v in W])
+
+    def start(self, dH):
+        # A MIP start with the upgrades dH satisfying every lazy row: Y from the failure levels, W[q] = 1 where the
+        # failed links disconnect the network
+        fails = self.scenario_levels > np.asarray(dH)[:, None]
+        w = [self.oracle.is_cut_without(set(np.flatnonzero(f).tolist())) for f in fails.T]
+        return ([(v, float(d)) for v, d in zip(self.deltaH, dH)] +
+                [(v, float(f)) for v, f in zip(self.Y, fails[self.Y_links, self.Y_scenarios])] +
+                [(v, float(f)) for v, f in zip(self.W, w)])
+
+    def add_violated_rows(self, model, Y=None, W=None):
+        # Adds the rows violated by the solution of model (in terms of its variables Y and W), returns their number
+        Y, W = Y or self.Y, W or self.W
+        rows = self.violated_rows(*self.values(Y, W))
+        for c, q in rows:
+            y = [Y[self.Y_position[l,q]] for l in c if (l,q) in self.Y_position]
+            model += W[q] >= xsum(y) - len(y) + 1
+            self.rows.add((tuple(c), q))
+        count('lazy_rows', len(rows))
+        return len(rows)
+
+    def generate_constrs(self, model, depth=0, npass=0):
+        # the model of the callback can be a preprocessed copy
+        self.add_violated_rows(model, model.translate(self.Y), model.translate(self.W))
+        count('lazy_calls')
+
+def build_lazy_model(network, intensity, prob_matrix, H, ub=3, TFA=1., solver_name=GRB, cut_srlgs=(), callback=None):
+    # The presolved model without SRLG rows: Y, W and the TFA constraint over the scenarios that can disconnect the
+    # network, the rows of the cuts binding at the incumbents are added by CutRowGenerator. The cut SRLGs given
+    # (e.g. a truncated list) are only the first cuts tried by the generator.
+    # callback: the rows are added by the lazy constraint callback of the solver during the search, otherwise by
+    # solve_model between optimizations (the default for CBC, which turns its heuristics off and drops the MIP start
+    # when a lazy constraint generator is set).
+    # Returns the model, the deltaH variables and the TFA constraint (None without a disconnecting scenario of positive
+    # probability); the generator is model.cut_row_generator.
+    network = compile_network(network, cut_srlgs)
+    oracle = CutOracle(network.network)
+    L = len(network)
+    with span('presolve_connectivity'):
+        scenario_levels, scenario_probabilities, forced = presolve_connectivity_scenarios(network, intensity, prob_matrix, H, ub, oracle)
+    Q = len(scenario_probabilities)
+
+    callback = solver_name != CBC if callback is None else callback
+    model = Model(sense=MINIMIZE, solver_name=solver_name)
+
+    #Variables
+    deltaH = [model.add_var(name=f'dH_{l}', var_type=INTEGER, lb=0, ub=ub) for l in range(L)]
+    Y = {(l,q): model.add_var(var_type=BINARY) for l,q in zip(*np.nonzero((scenario_levels > 0) & (scenario_levels <= ub)))}
+    W = [model.add_var(var_type=BINARY, lb=int(forced[q])) for q in range(Q)]
+
+    #Objective Function
+    model.objective = xsum( network.length[l] * deltaH[l] for l in range(L) )
+
+    #Constraint 1
+    for (l,q), y in Y.items():
+        k = int(scenario_levels[l,q])
+        model.add_constr( k * y + deltaH[l] >= k )
+
+    #Constraint 4, the only one depending on the TFA, left out without a scenario of positive probability
+    tfa_constr = model.add_constr(xsum( W[q] * scenario_probabilities[q] for q in range(Q) ) <= TFA, name='TFA') if scenario_probabilities.any() else None
+
+    generator = CutRowGenerator(oracle, scenario_levels, ub, deltaH, Y, W)
+    for s in cut_srlgs:
+        generator.add_cut(network.srlg_indices(s))
+    model.cut_row_generator = generator
+    if callback:
+        model.lazy_constrs_generator = generator
+        # presolve could remove the variables the generator reads
+        model.preprocess = 0
+    # every link upgraded by ub is feasible whenever the TFA can be met at all
+    model.start = generator.start(np.full(L, ub))
+
+    annotate(scenarios=Q, forced=int(forced.sum()), callback=callback)
+    count('variables', model.num_cols)
+    count('constraints', model.num_rows)
+    return model, deltaH, tfa_constr
+
+def solve_model(model, max_seconds=INF):
+    # model.optimize, and for a row generation model without callback, the rounds of adding the rows violated by the
+    # optimum and solving again until none is. The rows are valid at every TFA, so they are kept for the next solves.
+    # A round stopped by the time limit with violated rows left has no valid solution.
+    generator = getattr(model, 'cut_row_generator', None)
+    if generator is None or model.lazy_constrs_generator is not None:
+        return model.optimize(max_seconds=max_seconds)
+    deadline = time.perf_counter() + max_seconds
+    while True:
+        status = model.optimize(max_seconds=max(deadline - time.perf_counter(), 0))
+        count('row_generation_rounds')
+        if not model.num_solutions:
+            return status
+        if not generator.add_violated_rows(model):
+            return status
+        if status != OptimizationStatus.OPTIMAL or time.perf_counter() >= deadline:
+            return OptimizationStatus.NO_SOLUTION_FOUND
+
+
+# Heuristic starts
+class HeuristicStart:
+    # Incumbents of a FRADIR model from the heuristics: the cheapest upgrade of H1 and H2 at the TFA within the upper
+    # bounds of deltaH, as a MIP start with the Y, Z and W values it implies. Y, Z and W are found by name in a model
+    # read from write_model_lp (with the failure levels of presolve_scenarios, in the same scenario order) and by the
+    # CutRowGenerator in a row generation model; the other models only get the deltaH values.
+    def __init__(self, model, deltaH, network, cut_srlgs, intensity, prob_matrix, H, versions=(1, 2), processes=None):
+        self.model, self.deltaH = model, deltaH
+        self.network = compile_network(network, cut_srlgs)
+        self.cut_srlgs, self.intensity, self.prob_matrix = cut_srlgs, intensity, prob_matrix
+        self.H = np.asarray(H, dtype=int)
+        self.versions, self.processes = versions, processes
+        self.ub, self.cutoff = np.array([v.ub for v in deltaH]), model.cutoff
+        self.generator = getattr(model, 'cut_row_generator', None)
+        if self.generator is None:
+            self._index_variables()
+
+    def _index_variables(self):
+        # The variables of write_model_lp by kind and indices: y_{l}_{q}, z_{c}_{q} and w_{q}
+        names = {'y': [], 'z': [], 'w': []}
+        for v in self.model.vars:
+            kind, _, indices = v.name.partition('_')
+            if kind in names and indices:
+                names[kind].append((v, *map(int, indices.split('_'))))
+        self.Y, self.Z, self.W = ([row[0] for row in names[kind]] for kind in 'yzw')
+        self.Y_l, self.Y_q = (np.array([row[i] for row in names['y']], dtype=int) for i in (1, 2))
+        self.Z_c, self.Z_q = (np.array([row[i] for row in names['z']], dtype=int) for i in (1, 2))
+        self.W_q = np.array([row[1] for row in names['w']], dtype=int)
+        if self.Y or self.W:
+            self.scenario_levels, _, _ = presolve_scenarios(self.network, self.cut_srlgs, self.intensity, self.prob_matrix, self.H, int(self.ub.max()))
+            self.srlg_links = [self.network.srlg_indices(s) for s in self.cut_srlgs]
+
+    def start(self, dH):
+        # MIP start of the upgrades dH
+        dH = np.asarray(dH)
+        if self.generator is not None:
+            return self.generator.start(dH)
+        start = [(v, float(d)) for v, d in zip(self.deltaH, dH)]
+        if self.Y or self.W:
+            fails = self.scenario_levels > dH[:, None]
+            occurs = np.array([fails[s].all(axis=0) for s in self.srlg_links]).reshape(len(self.srlg_links), -1)
+            start += [(v, float(f)) for v, f in zip(self.Y, fails[self.Y_l, self.Y_q])]
+            start += [(v, float(o)) for v, o in zip(self.Z, occurs[self.Z_c, self.Z_q])]
+            start += [(v, float(o)) for v, o in zip(self.W, occurs[:, self.W_q].any(axis=0))]
+        return start
+
+    def solution(self, TFA, tfa_constr):
+        # The cheapest heuristic upgrade whose start meets the TFA constraint, as (cost, MIP start); (INF, None) if none
+        best_cost, best_start = INF, None
+        coefficients = tfa_constr.expr.expr if tfa_constr is not None else {}
+        for version in self.versions:
+            # stopped as soon as it would upgrade a link past the upper bound of its deltaH (cost INF)
+            H, cost = heuristic(version, self.cut_srlgs, self.network, self.intensity, self.H.copy(), self.prob_matrix, TFA,
+                                self.processes, max_tolerance=self.H + self.ub)
+            if cost >= best_cost:
+                continue
+            start = self.start(H - self.H)
+            if sum(coefficients.get(v, 0.) * x for v, x in start) <= TFA + 1e-12:
+                best_cost, best_start = float(cost), start
+        return best_cost, best_start
+
+    def bound(self, cost):
+        # Objective cutoff at cost, and deltaH[l] <= floor(cost / length[l]): a link upgraded past it alone costs more.
+        # The cutoff and upper bounds are restored to the model's ones when cost is INF.
+        self.model.cutoff = cost + 1e-6 * max(1., cost) if cost < INF else self.cutoff
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ub = np.fmin(self.ub, np.floor(cost / self.network.length + 1e-9))
+        for v, b in zip(self.deltaH, ub):
+            v.ub = b
+        count('fixed_upgrades', int((ub == 0).sum()))
+
+def time_to_solution(build, cost, max_seconds=INF):
+    # Seconds until the solver finds a solution of cost at most cost (within 1e-6) on the model of build() from its own
+    # start. No cutoff, which would also cut off a solution at exactly that cost: the solve is stopped at its k-th
+    # solution for k = 1, 2, ... on a new model each time, until the k-th solution is good enough. NaN if none is found
+    # in time, or for a row generation model without callback (its intermediate solutions are not solutions of the
+    # model).
+    tolerance = 1e-6 * max(1., cost)
+    k = 1
+    while True:
+        model = build()[0]
+        if getattr(model, 'cut_row_generator', None) is not None and model.lazy_constrs_generator is None:
+            return np.nan
+        model.max_solutions = k
+        start = time.perf_counter()
+        status = model.optimize(max_seconds=max_seconds)
+        elapsed = time.perf_counter() - start
+        count('time_to_solution_probes')
+        if model.num_solutions and model.objective_value <= cost + tolerance:
+            return elapsed
+        # the search ended before its k-th solution: optimum, infeasible or time limit (CBC keeps only the best
+        # solution, so num_solutions does not tell)
+        if status != OptimizationStatus.FEASIBLE or elapsed >= max_seconds:
+            return np.nan
+        k += 1
+
+def solution_upgrades(model, deltaH, status, start=None):
+    # The upgrades of the solve and its status. A solve ending without a solution falls back to the MIP start, which is
+    # feasible: optimal if the solver found the model infeasible (nothing cheaper than the cutoff above the start's cost,
+    # CBC can discard a start that is exactly at the optimum), feasible if it ran out of time. (None, status) without
+    # a start.
+    if model.num_solutions and status != OptimizationStatus.NO_SOLUTION_FOUND:
+        return np.array([int(v.x + 0.1) for v in deltaH]), status
+    if start is None:
+        return None, status
+    values = dict(start)
+    dH = np.array([int(values.get(v, 0.) + 0.1) for v in deltaH])
+    if status == OptimizationStatus.INFEASIBLE:
+        return dH, OptimizationStatus.OPTIMAL
+    return dH, OptimizationStatus.FEASIBLE
+
+
+# Bulk LP writer
+def _write_terms(f, coefficients, names, terms_per_line=8):
+    for start in range(0, len(names), terms_per_line):
+        f.write(' ' + ' '.join(f'{c:+.17g} {n}' for c, n in zip(coefficients[start:start+terms_per_line], names[start:start+terms_per_line])) + '\n')
+
+def _write_names(f, names, names_per_line=16):
+    for start in range(0, len(names), names_per_line):
+        f.write(' ' + ' '.join(names[start:start+names_per_line]) + '\n')
+
+def write_model_lp(lp_file, network, cut_srlgs, intensity, prob_matrix, H, ub=3, TFA=1., chunk_size=100000):
+    # Writes the presolved model of build_presolved_model straight to an LP file, constraint block by constraint block,
+    # without building the python-mip expressions. The SRLGs are translated to link indices once and the
+    # coefficients of every block are taken from the [L,Q] failure level matrix.
+    # Returns the build time and the peak memory usage.
+    with span('write_model_lp', ub=ub):
+        start = time.perf_counter()
+        network = compile_network(network, cut_srlgs)
+        L = len(network)
+        lengths = network.length
+        srlg_links = [network.srlg_indices(s) for s in cut_srlgs]
+        scenario_levels, scenario_probabilities, _ = presolve_scenarios(network, cut_srlgs, intensity, prob_matrix, H, ub)
+        Q = len(scenario_probabilities)
+        variable = (scenario_levels > 0) & (scenario_levels <= ub)
+        Y_l, Y_q = np.nonzero(variable)
+        Z_c, Z_q = [], []
+        forced = np.zeros(Q, dtype=bool)
+
+        with open(lp_file, 'w') as f:
+            f.write('\\ FRADIR\nMinimize\n obj:\n')
+            _write_terms(f, lengths, [f'dH_{l}' for l in range(L)])
+            f.write('Subject To\n')
+
+            #Constraint 1
+            for i in range(0, len(Y_l), chunk_size):
+                f.write(''.join(f' c1_{l}_{q}: {k} y_{l}_{q} + dH_{l} >= {k}\n' for l, q, k in
+                                zip(Y_l[i:i+chunk_size], Y_q[i:i+chunk_size], scenario_levels[Y_l[i:i+chunk_size], Y_q[i:i+chunk_size]])))
+
+            #Constraint 2 & 3
+            for c, s in enumerate(srlg_links):
+                qs = np.flatnonzero((scenario_levels[s] > 0).all(axis=0))
+                var_mask = variable[s][:, qs]
+                n_var = var_mask.sum(axis=0)
+                forced[qs[n_var == 0]] = True
+                qs, var_mask, n_var = qs[n_var > 0], var_mask[:, n_var > 0], n_var[n_var > 0]
+                f.write(''.join(f' c2_{c}_{q}: z_{c}_{q} ' + ' '.join(f'- y_{l}_{q}' for l in s[mask]) + f' >= {1 - n}\n'
+                                f' c3_{c}_{q}: w_{q} - z_{c}_{q} >= 0\n' for q, mask, n in zip(qs, var_mask.T, n_var)))
+                Z_c.append(np.full(len(qs), c))
+                Z_q.append(qs)
+            f.write(''.join(f' f_{q}: w_{q} >= 1\n' for q in np.flatnonzero(forced)))
+
+            #Constraint 4, the only one depending on the TFA, left out without a scenario of positive probability
+            # (a row without nonzero coefficients aborts CBC)
+            if scenario_probabilities.any():
+                f.write(' TFA:\n')
+                _write_terms(f, scenario_probabilities, [f'w_{q}' for q in range(Q)])
+                f.write(f' <= {TFA:.17g}\n')
+
+            f.write('Bounds\n')
+            f.write(''.join(f' 0 <= dH_{l} <= {ub}\n' for l in range(L)))
+            f.write('General\n')
+            _write_names(f, [f'dH_{l}' for l in range(L)])
+            f.write('Binary\n')
+            for i in range(0, len(Y_l), chunk_size):
+                _write_names(f, [f'y_{l}_{q}' for l, q in zip(Y_l[i:i+chunk_size], Y_q[i:i+chunk_size])])
+            for cs, qs in zip(Z_c, Z_q):
+                _write_names(f, [f'z_{c}_{q}' for c, q in zip(cs, qs)])
+            _write_names(f, [f'w_{q}' for q in range(Q)])
+            f.write('End\n')
+
+        stats = {'build_time': time.perf_counter() - start,
+                 'peak_memory_MB': peak_rss_MB(),
+                 'variables': L + len(Y_l) + sum(map(len, Z_q)) + Q,
+                 'constraints': len(Y_l) + 2 * sum(map(len, Z_q)) + int(forced.sum()) + int(scenario_probabilities.any())}
+        annotate(scenarios=Q)
+        count('variables', stats['variables'])
+        count('constraints', stats['constraints'])
+        return stats
+
+
+def read_model(lp_file, L, solver_name=GRB):
+    # A model written by write_model_lp (the TFA constraint is None if it has no TFA row), or by build_model: then the
+    # deltaH variables come first and the TFA constraint last
+    model = Model(sense=MINIMIZE, solver_name=solver_name)
+    model.read(lp_file)
+    if model.var_by_name('dH_0') is not None:
+        return model, [model.var_by_name(f'dH_{l}') for l in range(L)], model.constr_by_name('TFA')
+    return model, model.vars[:L], model.constrs[-1]
+
+
+def sweep_TFA(model, deltaH, tfa_constr, network, TFAs, warm_start=True, max_seconds=INF, heuristic_start=None):
+    # Solves the same model for every TFA, only changing the right-hand side of the TFA constraint (if there is one).
+    # The TFAs are solved from the tightest to the loosest, so the previous optimum is a feasible MIP start of the next one.
+    # heuristic_start: a HeuristicStart, the cheaper of its solution and the previous optimum is the MIP start, its cost
+    # the objective cutoff and the bound of the deltaH upgrades (the runtime includes the heuristics).
+    # A solve ending without a solution falls back to its start (see solution_upgrades); without a start, the TFA has
+    # cost NaN and upgrades -1.
+    # Returns the cost and runtime per TFA, and the upgrade of every link per TFA.
+    network = compile_network(network)
+    L = len(network)
+    results, upgrades = [], []
+    start_solution, start_cost = None, INF
+    for TFA in sorted(TFAs):
+        if tfa_constr is not None:
+            tfa_constr.rhs = TFA
+        if not warm_start:
+            # nor the MIP start set for the previous TFA (or by build_lazy_model)
+            start_solution, start_cost = None, INF
+            model.start = []
+        start = time.perf_counter()
+        if heuristic_start is not None:
+            with span('heuristic_start', TFA=TFA):
+                cost, solution = heuristic_start.solution(TFA, tfa_constr)
+                if cost < start_cost:
+                    start_solution, start_cost = solution, cost
+                heuristic_start.bound(start_cost)
+                annotate(heuristic_cost=cost, start_cost=start_cost)
+        if start_solution is not None:
+            model.start = start_solution
+        with span('solve', TFA=TFA, solver=model.solver_name):
+            status = solve_model(model, max_seconds=max_seconds)
+            runtime = time.perf_counter() - start
+            solved = model.num_solutions and status != OptimizationStatus.NO_SOLUTION_FOUND
+            annotate(status=status.name, objective=model.objective_value if solved else None)
+            count('solves')
+
+        dH, status = solution_upgrades(model, deltaH, status, start_solution)
+        if dH is not None:
+            if solved:
+                start_solution = [(v, v.x) for v in model.vars]
+            cost = float(dH @ network.length)
+            start_cost = cost
+        else:
+            dH = np.full(L, -1)
+            cost = np.nan
+        results.append({'TFA': TFA, 'Cost ILP': cost, 'Runtime ILP': runtime, 'Status': status.name})
+        upgrades += [{'TFA': TFA, 'Links': l, 'Delta H (ILP)': dH[l]} for l in range(L)]
+    if heuristic_start is not None:
+        heuristic_start.bound(INF)
+    return pd.DataFrame(results), pd.DataFrame(upgrades)
+
+
+# Inputs of the bundled networks
+FRADIR_INPUTS = {
+    'italy_995': {'cut_file': 'min_cut_SRLGs/italy_995_2-4', 'PSRLG_file': 'PSRLGs/italy_995.xml',
+                  'probability_file': 'earthquake_probabilities/italy_ds16.csv', 'attenuation': 'europe', 'ub': 3},
+    'usa_99': {'cut_file': 'min_cut_SRLGs/usa_99', 'PSRLG_file': 'PSRLGs/usa_99_complete_it6.xml',
+               'probability_file': 'earthquake_probabilities/usa_ds23.csv', 'attenuation': 'usa', 'ub': 4},
+    'usa_995': {'cut_file': 'min_cut_SRLGs/usa_995', 'PSRLG_file': 'PSRLGs/usa_995.xml',
+                'probability_file': 'earthquake_probabilities/usa_ds23.csv', 'attenuation': 'usa', 'ub': 3},
+}
+
+def load_fradir_inputs(network_name, cut_file=None, probability_file=None, attenuation=None, sparse_tolerance=None):
+    # The network, its cut SRLGs, the uint8 memory-mapped [L,P,M] intensity matrix and the [P,M] probability matrix.
+    # sparse_tolerance: the uint8 SparseIntensityMatrix of the epicenters that can exceed it instead (the smallest
+    # tolerance in use, Hnull)
+    inputs = FRADIR_INPUTS.get(network_name, {})
+    cut_file = cut_file or inputs['cut_file']
+    probability_file = probability_file or inputs['probability_file']
+    attenuation = attenuation or inputs['attenuation']
+    network_file = f'networks/{network_name}.gml'
+    g = nx.read_gml(network_file, label="id")
+    with open(cut_file, 'rb') as fp:
+        cut_srlgs = pickle.load(fp)
+    if sparse_tolerance is None:
+        intensity = get_intensity_matrix(network_file, probability_file, attenuation, mmap_mode='r', quantized=True)
+    else:
+        intensity = get_sparse_intensity_matrix(network_file, probability_file, attenuation, sparse_tolerance)
+    _, _, prob_matrix = read_earthquake_probabilities(probability_file)
+    return g, cut_srlgs, intensity, prob_matrix
+
+def get_initial_tolerances(network, Hnull=6, spine_bonus=0):
+    # H0 of every link: Hnull, plus spine_bonus on the spine links
+    return Hnull + spine_bonus * compile_network(network).onspine
+
+
+# Solver selection and the model cache
+_solvers = {}
+
+def available_solver(solver_name=GRB):
+    # solver_name if a model can be created with it (Gurobi needs a license), CBC otherwise
+    if solver_name not in _solvers:
+        try:
+            Model(solver_name=solver_name)
+            _solvers[solver_name] = solver_name
+        except Exception as e:
+            print(f'{solver_name} is not available ({str(e).splitlines()[0]}), using {CBC}')
+            _solvers[solver_name] = CBC
+    return _solvers[solver_name]
+
+def model_cache_key(network, cut_srlgs, intensity, prob_matrix, H, ub):
+    # Hash of everything the model depends on except the TFA, which is only the right-hand side of one constraint.
+    # The intensities enter through their failure levels, so the float and the uint8 cube give the same key.
+    network = compile_network(network, cut_srlgs)
+    h = hashlib.sha256()
+    h.update(repr(network.edges).encode())
+    h.update(network.length.tobytes())
+    for s in cut_srlgs:
+        h.update(np.asarray(network.srlg_indices(s), dtype=np.int64).tobytes() + b';')
+    h.update(np.asarray(H, dtype=np.int64).tobytes())
+    h.update(f'{ub}'.encode())
+    for l in range(len(network)):
+        h.update(get_failure_levels(intensity[l:l+1], H[l:l+1], ub).tobytes())
+    h.update(np.ascontiguousarray(prob_matrix, dtype=np.float64).tobytes())
+    # the code the LP file depends on
+    for function in (get_failure_levels, presolve_scenarios, write_model_lp):
+        h.update(inspect.getsource(function).encode())
+    return h.hexdigest()[:16]
+
+def cached_model_lp(network, cut_srlgs, intensity, prob_matrix, H, ub=3, tfa=1., cache_dir='models'):
+    # The LP file of write_model_lp in cache_dir under the hash of the inputs, written if it is not there yet
+    lp_file = os.path.join(cache_dir, f'fradir_{model_cache_key(network, cut_srlgs, intensity, prob_matrix, H, ub)}.lp')
+    annotate(lp_file=lp_file, cached=os.path.exists(lp_file))
+    if not os.path.exists(lp_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f'{lp_file}.{os.getpid()}.tmp'
+        write_model_lp(tmp_file, network, cut_srlgs, intensity, prob_matrix, H, ub, tfa)
+        os.replace(tmp_file, lp_file)
+    return lp_file
+
+def build_fradir_model(network, cut_srlgs, intensity, prob_matrix, H0=6, spine_bonus=0, ub=3, tfa=1., solver=GRB, cache_dir='models', lazy=False):
+    # The presolved FRADIR model with tolerances H0 + spine_bonus*onspine (H0 a number or a per-link array).
+    # The LP file is cached in cache_dir under the hash of the inputs, so the same model is written only once;
+    # falls back to CBC when the solver cannot be used.
+    # lazy: the row generation model of build_lazy_model instead, not cached (the cut SRLGs are only its first cuts).
+    # Returns the model, the deltaH variables and the TFA constraint (None when no scenario survives the presolve).
+    network = compile_network(network, cut_srlgs)
+    H = np.asarray(H0 + spine_bonus * network.onspine, dtype=int)
+    solver = available_solver(solver)
+    if lazy:
+        with span('build_fradir_model', spine_bonus=spine_bonus, ub=ub, solver=solver, lazy=True):
+            return build_lazy_model(network, intensity, prob_matrix, H, ub, tfa, solver, cut_srlgs)
+    with span('build_fradir_model', spine_bonus=spine_bonus, ub=ub, solver=solver):
+        lp_file = cached_model_lp(network, cut_srlgs, intensity, prob_matrix, H, ub, tfa, cache_dir)
+        with span('read_model'):
+            model, deltaH, tfa_constr = read_model(lp_file, len(network), solver)
+        if tfa_constr is not None:
+            tfa_constr.rhs = tfa
+    return model, deltaH, tfa_constr
+
+def compare_starts(network, cut_srlgs, intensity, prob_matrix, TFAs, H0=6, spine_bonus=0, ub=3, solver=GRB, cache_dir='models', lazy=False, max_seconds=INF, processes=None):
+    # The cold start against the heuristic start (MIP start, cutoff and bounds of HeuristicStart) at every TFA, every
+    # solve on its own model from build_fradir_model so that no solver state is shared. First good solution: seconds
+    # to a solution as cheap as the best heuristic, the heuristic runtime for the heuristic start.
+    # Returns the cost, status, first good solution and total runtime per TFA and start.
+    network = compile_network(network, cut_srlgs)
+    H = np.asarray(H0 + spine_bonus * network.onspine, dtype=int)
+
+    def build(TFA):
+        return build_fradir_model(network, cut_srlgs, intensity, prob_matrix, H0, spine_bonus, ub, TFA, solver, cache_dir, lazy)
+
+    rows = []
+    for TFA in sorted(TFAs):
+        with span('compare_starts', TFA=TFA):
+            model, deltaH, tfa_constr = build(TFA)
+            heuristic_start = HeuristicStart(model, deltaH, network, cut_srlgs, intensity, prob_matrix, H, processes=processes)
+            start = time.perf_counter()
+            heuristic_cost, solution = heuristic_start.solution(TFA, tfa_constr)
+            heuristic_time = time.perf_counter() - start
+            if solution is not None:
+                model.start = solution
+                heuristic_start.bound(heuristic_cost)
+            status = solve_model(model, max_seconds=max_seconds)
+            runtimes = {'heuristic': (heuristic_time if solution is not None else np.nan, time.perf_counter() - start)}
+            outcomes = {'heuristic': solution_upgrades(model, deltaH, status, solution)}
+
+            first = time_to_solution(lambda: build(TFA), heuristic_cost, max_seconds) if heuristic_cost < INF else np.nan
+            model, deltaH, tfa_constr = build(TFA)
+            start = time.perf_counter()
+            status = solve_model(model, max_seconds=max_seconds)
+            runtimes['cold'] = (first, time.perf_counter() - start)
+            outcomes['cold'] = solution_upgrades(model, deltaH, status)
+
+        for name in ('cold', 'heuristic'):
+            dH, status = outcomes[name]
+            cost = float(dH @ network.length) if dH is not None else np.nan
+            rows.append({'TFA': TFA, 'Start': name, 'Heuristic cost': heuristic_cost, 'Cost ILP': cost, 'Status': status.name,
+                         'First good solution': runtimes[name][0], 'Runtime ILP': runtimes[name][1]})
+    return pd.DataFrame(rows)
@@ -0,0 +1,151 @@
+import json
+import os
+import sys
+import time
+import resource
+import cProfile
+import itertools
+from contextlib import contextmanager
+
+try:
+    from tqdm.auto import tqdm as _tqdm
+except ImportError:
+    _tqdm = None
+
+# Stage-level instrumentation: timed spans with memory usage and counters, written as JSON lines so runs can be
+# compared, optional profiling of the spans, and progress bars that are safe outside notebooks.
+# Set up with configure(...) or from the environment of a batch job:
+#   FRADIR_TRACE=run.jsonl          append one JSON line per finished span
+#   FRADIR_RUN=italy_SB1            run id stored in every line (default: start time and pid)
+#   FRADIR_ECHO=1                   print a summary line of every finished span to stderr
+#   FRADIR_PROFILE=cprofile         profile the outermost spans (cprofile or pyinstrument) ...
+#   FRADIR_PROFILE_DIR=profiles     ... into this directory
+#   FRADIR_PROGRESS=0               no progress bars
+
+_config = {
+    'trace': os.environ.get('FRADIR_TRACE'),
+    'run': os.environ.get('FRADIR_RUN', f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"),
+    'echo': os.environ.get('FRADIR_ECHO', '0') != '0',
+    'profile': os.environ.get('FRADIR_PROFILE'),
+    'profile_dir': os.environ.get('FRADIR_PROFILE_DIR', 'profiles'),
+    'progress': os.environ.get('FRADIR_PROGRESS', '1') != '0',
+}
+_open_spans = []
+_profile_ids = itertools.count()
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+def configure(**options):
+    # Changes the options above (trace, run, echo, profile, profile_dir, progress), returns the previous ones
+    unknown = set(options) - set(_config)
+    if unknown:
+        raise ValueError(f'Unknown instrumentation options {sorted(unknown)}')
+    if options.get('profile') not in (None, *PROFILERS):
+        raise ValueError(f"Unknown profiler {options['profile']}, choose from {PROFILERS}")
+    previous = dict(_config)
+    _config.update(options)
+    return previous
+
+
+# Memory
+def current_rss_MB():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return peak_rss_MB()
+
+def peak_rss_MB():
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+# Spans
+def count(name, n=1):
+    # Adds n to a counter of the innermost open span, the counters are summed into the enclosing spans
+    if _open_spans:
+        counters = _open_spans[-1]['counters']
+        counters[name] = counters.get(name, 0) + n
+
+def annotate(**fields):
+    # Extra fields of the innermost open span's record
+    if _open_spans:
+        _open_spans[-1]['fields'].update(fields)
+
+@contextmanager
+def _profiled(name, profiler):
+    os.makedirs(_config['profile_dir'], exist_ok=True)
+    path = os.path.join(_config['profile_dir'], f"{name}-{_config['run']}-{next(_profile_ids)}")
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            yield path + '.html'
+        finally:
+            profile.stop()
+            with open(path + '.html', 'w') as f:
+                f.write(profile.output_html())
+    else:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield path + '.prof'
+        finally:
+            profile.disable()
+            profile.dump_stats(path + '.prof')
+
+@contextmanager
+def span(name, profile=None, **fields):
+    # Times the enclosed stage and records its wall and CPU time, the change of the resident memory and of its peak,
+    # its counters and fields. profile='cprofile' or 'pyinstrument' profiles it; the outermost spans are profiled
+    # with the configured profiler.
+    profile = profile or (_config['profile'] if not _open_spans else None)
+    record = {'name': name, 'counters': {}, 'fields': dict(fields)}
+    _open_spans.append(record)
+    rss, peak = current_rss_MB(), peak_rss_MB()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        if profile:
+            with _profiled(name, profile) as profile_file:
+                record['fields']['profile'] = profile_file
+                yield record
+        else:
+            yield record
+    finally:
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        _open_spans.pop()
+        if _open_spans:
+            for counter, n in record['counters'].items():
+                count(counter, n)
+        _emit({'run': _config['run'], 'span': '/'.join([s['name'] for s in _open_spans] + [name]),
+               'wall_s': wall, 'cpu_s': cpu, 'rss_MB': current_rss_MB(), 'rss_delta_MB': current_rss_MB() - rss,
+               'peak_rss_MB': peak_rss_MB(), 'peak_rss_delta_MB': peak_rss_MB() - peak,
+               'counters': record['counters'], **record['fields']})
+
+def _emit(line):
+    if _config['trace']:
+        with open(_config['trace'], 'a') as f:
+            f.write(json.dumps(line, default=str) + '\n')
+    if _config['echo']:
+        counters = ''.join(f', {counter}: {n}' for counter, n in line['counters'].items())
+        print(f"{line['span']}: {line['wall_s']:.1f} s, peak memory {line['peak_rss_MB']:.0f} MB "
+              f"(+{line['peak_rss_delta_MB']:.0f} MB){counters}", file=sys.stderr)
+
+
+# Progress bars
+def _in_ipython():
+    try:
+        from IPython import get_ipython
+    except ImportError:
+        return False
+    return get_ipython() is not None
+
+def progress(iterable, **kwargs):
+    # tqdm.auto when it is installed and the progress bars are on: a widget in notebooks, a text bar on terminals
+    # and nothing when stderr is not a terminal (batch logs). The notebook streams are never terminals, so the
+    # bars are always on under IPython.
+    if _tqdm is None or not _config['progress']:
+        return iterable
+    return _tqdm(iterable, disable=False if _in_ipython() else None, **kwargs)
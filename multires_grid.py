@@ -0,0 +1,49 @@
+import argparse
+from ilp_model import *
+from instrumentation import configure
+
+# Builds the multi-resolution earthquake grid of a network from its full grid and reports its error against it
+#   python multires_grid.py italy_995 --max-error 0.01
+#   python multires_grid.py usa_995 --max-error 0 0.01 0.05 --compare-downsampling 1 2
+# Writes earthquake_probabilities/{grid}_mr{max_error}.csv in the layout of the full grid, so it can be passed as
+# the probability file of build_intensities.py, fradir_model.py or load_fradir_inputs, and the error report to
+# results/{network}/grid_report_{grid}.csv.
+
+parser = argparse.ArgumentParser(description='Build multi-resolution earthquake grids')
+parser.add_argument('network', help=f'network name, with bundled inputs for {sorted(FRADIR_INPUTS)}')
+parser.add_argument('--max-error', type=float, nargs='+', default=[0.01], help='probability moved across the failure boundaries, relative to the failure probability of every link and level')
+parser.add_argument('--max-depth', type=int, default=6, help='largest cells of 2**max_depth x 2**max_depth epicenters')
+parser.add_argument('--hnull', type=int, default=6, help='smallest tolerance in use')
+parser.add_argument('--max-tolerance', type=int, default=11, help='largest tolerance in use (Hnull + spine bonus + ub)')
+parser.add_argument('--cut-file', help='cut SRLGs of the report (default: per network)')
+parser.add_argument('--probability-file', help='full earthquake grid (default: per network)')
+parser.add_argument('--attenuation', choices=sorted(ATTENUATION_MODELS), help='attenuation model (default: per network)')
+parser.add_argument('--compare-downsampling', type=int, nargs='*', default=[], help='also report the uniform downsampling to 1/res degree')
+args = parser.parse_args()
+
+configure(echo=True)
+inputs = FRADIR_INPUTS.get(args.network, {})
+probability_file = args.probability_file or inputs['probability_file']
+attenuation = ATTENUATION_MODELS[args.attenuation or inputs['attenuation']]
+cut_file = args.cut_file or inputs['cut_file']
+g = nx.read_gml(f'networks/{args.network}.gml', label='id')
+with open(cut_file, 'rb') as fp:
+    cut_srlgs = pickle.load(fp)
+epicenters, magnitudes, prob_matrix = read_earthquake_probabilities(probability_file)
+tolerances = range(args.hnull, args.max_tolerance + 1)
+
+grid_name = os.path.splitext(os.path.basename(probability_file))[0]
+grids = {grid_name: (epicenters, prob_matrix)}
+for max_error in args.max_error:
+    cell_epicenters, cell_probabilities, depths, _ = build_multiresolution_grid(g, epicenters, magnitudes, prob_matrix, attenuation, tolerances, max_error, args.max_depth)
+    grid_file = os.path.join(os.path.dirname(probability_file), f'{grid_name}_mr{max_error:g}.csv')
+    write_earthquake_probabilities(grid_file, cell_epicenters, magnitudes, cell_probabilities)
+    print(f'{grid_file}: {len(epicenters)} -> {len(cell_epicenters)} epicenters, cells per depth {np.bincount(depths).tolist()}')
+    grids[f'{grid_name}_mr{max_error:g}'] = cell_epicenters, cell_probabilities
+for res in args.compare_downsampling:
+    grids[f'{grid_name}_res{res}'] = downsample_earthquake_grid(epicenters, prob_matrix, res)
+
+report = grid_error_report(g, cut_srlgs, grids, magnitudes, attenuation, tolerances)
+print(report.T.to_string())
+os.makedirs(f'results/{args.network}', exist_ok=True)
+report.to_csv(f'results/{args.network}/grid_report_{grid_name}.csv', index=False)
@@ -1,84 +1,59 @@
-from mip import *
-from backend import *
-from itertools import product
-import time
-import resource
+from ilp_model import *
+from instrumentation import configure
 
 network_name = 'italy_995'
 spine_bonus = 1
 
-# The network
-g = nx.read_gml(f'networks/{network_name}.gml', label="id")
-L = len(g.edges)
-links = range(L)
-
-
-# The cut SRLGs
-with open (f'min_cut_SRLGs/{network_name}_2-4', 'rb') as fp:
-    cut_srlgs = pickle.load(fp)
-S = len(cut_srlgs)
-
-
-# All SRLG
-all_srlgs, _ = get_SRLGs(f'PSRLGs/{network_name}.xml')
+# Timings, memory and model sizes of the stages, as JSON lines and on stderr
+configure(trace=f'results/{network_name}/trace_{network_name}_SB{spine_bonus}.jsonl', echo=True)
 
+# The network, the cut SRLGs, the matrix of the intensity values [L,P,M] (link, position, magnitude, uint8 ceil(intensity),
+# memory-mapped) and the matrix of earthquake probabilities [P,M] (position, magnitude)
+g, cut_srlgs, intensity, prob_matrix = load_fradir_inputs(network_name)
+L = len(g.edges)
+P, M = prob_matrix.shape
 
-# The matrix of the intensity values, dimensions: [L,P,M] (link, position, magnitude)
-intensity = np.load(f'intensities/{network_name}_ds16.npy')
+# All SRLG, as CSR offsets and link indices (cached next to the XML)
+srlg_offsets, srlg_links, _ = get_cached_SRLGs_csr(FRADIR_INPUTS[network_name]['PSRLG_file'], g)
 
 
-# The matrix of earthquake probabilities, dimensions: [P,M] (position, magnitude)
-prob_matrix = pd.read_csv('earthquake_probabilities/italy_ds16.csv').drop(['Lat', 'Long'], axis=1).to_numpy()
-P, M = prob_matrix.shape
-epicenters = range(P)
-magnitudes = range(M)
-
 Hnull = 6
 Ts = [0.01, 0.005, 0.001, 0.0005]
+TFAs = [0.01, 0.009, 0.008, 0.007, 0.006, 0.005, 0.004, 0.003, 0.002, 0.001, 0.0009, 0.0008, 0.0007, 0.0006, 0.0005]
 
-#for idx, TFA in enumerate([0.01, 0.009, 0.008, 0.007, 0.006, 0.005, 0.004, 0.003, 0.002, 0.001, 0.0009, 0.0008, 0.0007, 0.0006, 0.0005]):
-for idx, TFA in enumerate([0.0009, 0.0008, 0.0007, 0.0006, 0.0005], 10):
-
-    start = time.perf_counter()
-    H = np.array([Hnull+spine_bonus*g.edges[e]['onspine'] for e in g.edges])
+H0 = get_initial_tolerances(g, Hnull, spine_bonus)
 
-    #Load model
-    model = Model(sense=MINIMIZE, solver_name=GRB)
-    model.read(f'results/{network_name}/{network_name}_SB{spine_bonus}.lp')
-    model.constrs[-1].rhs = TFA
+#Build the model once (or load it from the model cache), only the TFA changes between the solves
+model, deltaH, tfa_constr = build_fradir_model(g, cut_srlgs, intensity, prob_matrix, Hnull, spine_bonus, ub=3, solver=GRB)
+# The cheaper of H1 and H2 at every TFA as MIP start, objective cutoff and bound of the upgrades
+heuristic_start = HeuristicStart(model, deltaH, g, cut_srlgs, intensity, prob_matrix, H0)
+results, upgrades = sweep_TFA(model, deltaH, tfa_constr, g, TFAs, heuristic_start=heuristic_start)
+print(results)
 
-    #Start optimization
-    model.optimize()#max_seconds=
-    runtime_ILP = time.perf_counter()-start
-    print(f'Memory usage: {int(int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)/1000)} MB')
+# Index of the first failing magnitude of every link, epicenter and tolerance level, for the SRLG probabilities
+failure_index = CriticalMagnitudeIndex(intensity)
 
-    # The result
-    deltaH = model.vars[:L]
-    cost = 0
-    selected = []
-    dH = []
-    for l,e in enumerate(g.edges):
-        dH.append(int(deltaH[l].x + 0.1))
-        if deltaH[l].x >= 0.5:
-            selected.append((deltaH[l].x,e, g.edges[e]['length']))
-            cost += deltaH[l].x * g.edges[e]['length']
-    print(cost)
-    print(*selected, sep='\n')
-    H = H + np.array(dH)
+for TFA, upgrade in upgrades.groupby('TFA'):
+    dH = upgrade['Delta H (ILP)'].to_numpy()
+    # no solution (and no start to fall back to) in time: upgrades -1
+    if (dH < 0).any():
+        print(f'TFA {TFA}: no solution, skipped')
+        continue
+    H = H0 + dH
 
     if TFA in Ts:
-        for T in Ts:
-            active_srlgs = [srlg for srlg in all_srlgs if get_SRLG_probability(srlg, g, intensity, H, prob_matrix)>T]
-            write_networkx_to_srg(f'results/{network_name}/SRLG/SB{spine_bonus}/{network_name}_TFA{TFA:.4f}_T{T}_ILP_SB{spine_bonus}.srg', g, active_srlgs)
+        srlg_probabilities = get_SRLG_probabilities(srlg_offsets, srlg_links, failure_index, H, prob_matrix)
+        srg_files = [f'results/{network_name}/SRLG/SB{spine_bonus}/{network_name}_TFA{TFA:.4f}_T{T}_ILP_SB{spine_bonus}.srg' for T in Ts]
+        write_srg_buckets(srg_files, g, srlg_offsets, srlg_links, srlg_probabilities, Ts)
 
-    # Saving the result
-    df_cost = pd.read_csv(f'results/{network_name}/comparison_{network_name}_SB{spine_bonus}.csv')
-    df_cost.loc[idx,'Runtime ILP'] = runtime_ILP
-    df_cost.loc[idx,'Cost ILP'] = cost
-    df_cost.to_csv(f'results/{network_name}/comparison_{network_name}_SB{spine_bonus}.csv', index=False, float_format='%.4f')
-    
     df_H = pd.read_csv(f'results/{network_name}/upgrade_level/SB{spine_bonus}/upgrade_{network_name}_TFA{TFA:.4f}_SB{spine_bonus}.csv')
     df_H['Delta H (ILP)'] = dH
     df_H['H (ILP)'] = H
     df_H.to_csv(f'results/{network_name}/upgrade_level/SB{spine_bonus}/upgrade_{network_name}_TFA{TFA:.4f}_SB{spine_bonus}.csv', index=False, float_format='%.4f')
 
+# Saving the result
+df_cost = pd.read_csv(f'results/{network_name}/comparison_{network_name}_SB{spine_bonus}.csv')
+results = results.set_index(results['TFA'].round(4))
+df_cost = df_cost.set_index(df_cost['TFA'].round(4))
+df_cost.update(results[['Runtime ILP', 'Cost ILP']])
+df_cost.to_csv(f'results/{network_name}/comparison_{network_name}_SB{spine_bonus}.csv', index=False, float_format='%.4f')
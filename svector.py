@@ -1,7 +1,9 @@
 import math
 from typing import List, Tuple
 
-from vector import Vector
+import numpy as np
+
+from vector import Vector, great_circle_arc_distances
 
 
 class SVector:
@@ -31,3 +33,16 @@ def _xyz_from_latlon(lat: float, lon: float) -> Tuple[float]:
     y = math.cos(φ) * math.sin(λ)
     z = math.sin(φ)
     return (x, y, z)
+
+
+def _xyz_from_latlon_array(lat, lon):
+    φ, λ = np.radians(lat), np.radians(lon)
+    return np.stack((np.cos(φ) * np.cos(λ), np.cos(φ) * np.sin(λ), np.sin(φ)), axis=-1)
+
+
+# batched SVector.distance_to_section: P points against L sections -> [L,P] angular distances
+def distances_to_sections(lat, lon, src_lat, src_lon, dst_lat, dst_lon, chunk_size: int = 4096):
+    points = _xyz_from_latlon_array(lat, lon)
+    src = _xyz_from_latlon_array(src_lat, src_lon)
+    dst = _xyz_from_latlon_array(dst_lat, dst_lon)
+    return great_circle_arc_distances(points, src, dst, chunk_size)
@@ -0,0 +1,177 @@
+import argparse
+import sqlite3
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ilp_model import *
+from instrumentation import configure
+
+# Sweep over networks x spine bonus x method (ILP, H1, H2) x TFA. Every (network, spine bonus, method) is a job of a
+# process pool, solving its TFAs in order (the ILP warm-starts from the previous TFA). The results are written by
+# this process only, one transaction per job, to an append-only SQLite store; the TFAs already in the store are skipped.
+# Only complete solves are stored as results (an ILP solve must be OPTIMAL), the others (time limit, solver failure) go
+# to the failures table and are solved again on resume.
+#   python sweep.py --networks italy_995 usa_995 --spine-bonus 0 1 --jobs 4 --threads 2
+#   python sweep.py --export        comparison and upgrade level CSVs of results/ from the store
+
+METHODS = ('ILP', 'H1', 'H2')
+METHOD_COLUMNS = {'H1': 'Heuristic 1', 'H2': 'Heuristic 2', 'ILP': 'ILP'}
+TFAS = [0.01, 0.009, 0.008, 0.007, 0.006, 0.005, 0.004, 0.003, 0.002, 0.001, 0.0009, 0.0008, 0.0007, 0.0006, 0.0005]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    network TEXT, spine_bonus INTEGER, method TEXT, TFA REAL,
+    cost REAL, runtime REAL, status TEXT, cut_srlgs INTEGER, created REAL,
+    PRIMARY KEY (network, spine_bonus, method, TFA));
+CREATE TABLE IF NOT EXISTS upgrades (
+    network TEXT, spine_bonus INTEGER, method TEXT, TFA REAL, link INTEGER, delta_H INTEGER,
+    PRIMARY KEY (network, spine_bonus, method, TFA, link));
+CREATE TABLE IF NOT EXISTS failures (
+    network TEXT, spine_bonus INTEGER, method TEXT, error TEXT, created REAL);
+'''
+
+
+# Result store
+def open_store(store_file):
+    os.makedirs(os.path.dirname(store_file) or '.', exist_ok=True)
+    conn = sqlite3.connect(store_file)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+COMPLETE = "cost IS NOT NULL AND (method != 'ILP' OR status = 'OPTIMAL')"
+
+def is_complete(method, cost, status):
+    return not np.isnan(cost) and (method != 'ILP' or status == 'OPTIMAL')
+
+def finished_TFAs(conn, network_name, spine_bonus, method):
+    rows = conn.execute(f'SELECT TFA FROM results WHERE network=? AND spine_bonus=? AND method=? AND {COMPLETE}', (network_name, spine_bonus, method))
+    return {TFA for TFA, in rows}
+
+def store_results(conn, results, upgrades):
+    # One transaction per job. The incomplete solves are stored as failures; a complete solve replaces the incomplete
+    # row an older store may hold for its TFA (complete rows are never solved again).
+    complete = {(network_name, spine_bonus, method, TFA) for network_name, spine_bonus, method, TFA, cost, _, status, _, _ in results
+                if is_complete(method, cost, status)}
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?,?,?)', [r for r in results if r[:4] in complete])
+        conn.executemany('INSERT OR REPLACE INTO upgrades VALUES (?,?,?,?,?,?)', [u for u in upgrades if u[:4] in complete])
+        conn.executemany('INSERT INTO failures VALUES (?,?,?,?,?)',
+                         [(network_name, spine_bonus, method, f'TFA {TFA}: {status}, cost {cost}', created)
+                          for network_name, spine_bonus, method, TFA, cost, _, status, _, created in results
+                          if (network_name, spine_bonus, method, TFA) not in complete])
+    return len(complete)
+
+def store_failure(conn, network_name, spine_bonus, method, error):
+    with conn:
+        conn.execute('INSERT INTO failures VALUES (?,?,?,?,?)', (network_name, spine_bonus, method, error, time.time()))
+
+
+# Jobs
+def run_job(network_name, spine_bonus, method, TFAs, Hnull=6, solver=GRB, threads=1, max_seconds=INF):
+    # Solves the TFAs of one (network, spine bonus, method), returns the result and upgrade rows of the store
+    configure(run=f'{network_name}_SB{spine_bonus}_{method}', echo=False, progress=False)
+    g, cut_srlgs, intensity, prob_matrix = load_fradir_inputs(network_name)
+    network = compile_network(g, cut_srlgs)
+    H0 = get_initial_tolerances(network, Hnull, spine_bonus)
+    solved = []
+    if method == 'ILP':
+        ub = FRADIR_INPUTS[network_name].get('ub', 3)
+        model, deltaH, tfa_constr = build_fradir_model(network, cut_srlgs, intensity, prob_matrix, Hnull, spine_bonus, ub, max(TFAs), solver)
+        model.threads = threads
+        model.verbose = 0
+        results, upgrades = sweep_TFA(model, deltaH, tfa_constr, network, TFAs, max_seconds=max_seconds)
+        rows = results[['TFA', 'Cost ILP', 'Runtime ILP', 'Status']].itertuples(index=False, name=None)
+        for (TFA, cost, runtime, status), (_, upgrade) in zip(rows, upgrades.groupby('TFA', sort=True)):
+            solved.append((TFA, cost, runtime, status, upgrade['Delta H (ILP)'].to_numpy()))
+    else:
+        for TFA in TFAs:
+            start = time.perf_counter()
+            H, cost = heuristic(int(method[1]), cut_srlgs, network, intensity, H0.copy(), prob_matrix, TFA)
+            solved.append((TFA, float(cost), time.perf_counter() - start, 'FEASIBLE', H - H0))
+    created = time.time()
+    results = [(network_name, spine_bonus, method, TFA, cost, runtime, status, len(cut_srlgs), created)
+               for TFA, cost, runtime, status, _ in solved]
+    upgrades = [(network_name, spine_bonus, method, TFA, l, int(d)) for TFA, _, _, _, dH in solved for l, d in enumerate(dH)]
+    return results, upgrades
+
+def pending_jobs(conn, networks, spine_bonuses, methods, TFAs):
+    # ILP jobs first, they are the longest
+    jobs = []
+    for method in sorted(methods, key=lambda m: m != 'ILP'):
+        for network_name in networks:
+            for spine_bonus in spine_bonuses:
+                done = finished_TFAs(conn, network_name, spine_bonus, method)
+                todo = [TFA for TFA in TFAs if TFA not in done]
+                if todo:
+                    jobs.append((network_name, spine_bonus, method, todo))
+    return jobs
+
+def run_sweep(conn, jobs, processes=1, **options):
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {pool.submit(run_job, *job, **options): job for job in jobs}
+        for future in as_completed(futures):
+            network_name, spine_bonus, method, TFAs = futures[future]
+            try:
+                results, upgrades = future.result()
+            except Exception:
+                print(f'{network_name} SB{spine_bonus} {method} failed')
+                store_failure(conn, network_name, spine_bonus, method, traceback.format_exc())
+                continue
+            stored = store_results(conn, results, upgrades)
+            print(f'{network_name} SB{spine_bonus} {method}: {stored} TFAs stored, {len(results) - stored} incomplete')
+
+
+# Export to the CSV layout of results/
+def _write_csv(df, csv_file):
+    os.makedirs(os.path.dirname(csv_file), exist_ok=True)
+    tmp_file = f'{csv_file}.{os.getpid()}.tmp'
+    df.to_csv(tmp_file, index=False, float_format='%.4f')
+    os.replace(tmp_file, csv_file)
+
+def export_results(conn, results_dir='results', Hnull=6):
+    results = pd.read_sql_query(f'SELECT * FROM results WHERE {COMPLETE}', conn)
+    upgrades = pd.read_sql_query(f'SELECT upgrades.* FROM upgrades JOIN results USING (network, spine_bonus, method, TFA) WHERE {COMPLETE}', conn)
+    for (network_name, spine_bonus), df in results.groupby(['network', 'spine_bonus']):
+        df_cost = df.pivot(index='TFA', columns='method', values=['cost', 'runtime']).sort_index(ascending=False)
+        comparison = pd.DataFrame({'TFA': df_cost.index, 'Cut SRLGs': df.groupby('TFA')['cut_srlgs'].max().reindex(df_cost.index).to_numpy()})
+        for column, value in (('Cost', 'cost'), ('Runtime', 'runtime')):
+            for method in ('H1', 'H2', 'ILP'):
+                comparison[f'{column} {method}'] = df_cost[value][method].to_numpy() if method in df_cost[value] else np.nan
+        _write_csv(comparison, f'{results_dir}/{network_name}/comparison_{network_name}_SB{spine_bonus}.csv')
+
+        network = compile_network(nx.read_gml(f'networks/{network_name}.gml', label="id"))
+        H0 = get_initial_tolerances(network, Hnull, spine_bonus)
+        link_upgrades = upgrades[(upgrades['network'] == network_name) & (upgrades['spine_bonus'] == spine_bonus)]
+        for TFA, tfa_upgrades in link_upgrades.groupby('TFA'):
+            upgrade = pd.DataFrame({'Links': range(len(network)), 'Link Lengths': network.length, 'H0': H0})
+            dH = tfa_upgrades.pivot(index='link', columns='method', values='delta_H').reindex(range(len(network)))
+            for method in ('H1', 'H2', 'ILP'):
+                upgrade[f'Delta H ({METHOD_COLUMNS[method]})'] = dH[method].to_numpy() if method in dH else np.nan
+            for method in ('H1', 'H2', 'ILP'):
+                upgrade[f'H ({METHOD_COLUMNS[method]})'] = H0 + upgrade[f'Delta H ({METHOD_COLUMNS[method]})']
+            _write_csv(upgrade, f'{results_dir}/{network_name}/upgrade_level/SB{spine_bonus}/upgrade_{network_name}_TFA{TFA:.4f}_SB{spine_bonus}.csv')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the FRADIR sweep')
+    parser.add_argument('--networks', nargs='+', default=sorted(FRADIR_INPUTS))
+    parser.add_argument('--spine-bonus', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=list(METHODS))
+    parser.add_argument('--tfa', type=float, nargs='+', default=TFAS)
+    parser.add_argument('--hnull', type=int, default=6)
+    parser.add_argument('--solver', default=GRB, help=f'{GRB} or {CBC}, {CBC} is used when {GRB} is not available')
+    parser.add_argument('--jobs', type=int, default=1, help='number of jobs run at once')
+    parser.add_argument('--threads', type=int, default=1, help='solver threads of every job')
+    parser.add_argument('--max-seconds', type=float, default=INF, help='time limit of every solve')
+    parser.add_argument('--store', default='results/sweep.sqlite')
+    parser.add_argument('--export', action='store_true', help='only write the CSVs of results/ from the store')
+    args = parser.parse_args()
+
+    conn = open_store(args.store)
+    if args.export:
+        export_results(conn, Hnull=args.hnull)
+    else:
+        TFAs = [round(TFA, 10) for TFA in args.tfa]
+        jobs = pending_jobs(conn, args.networks, args.spine_bonus, args.methods, TFAs)
+        print(f'{len(jobs)} jobs to run')
+        run_sweep(conn, jobs, args.jobs, Hnull=args.hnull, solver=args.solver, threads=args.threads, max_seconds=args.max_seconds)
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # the input files are read relative to the repository root
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture(scope='session')
+def usa_995_subset():
+    # usa_995 on 60 evenly spaced epicenters: small enough for CBC in a fraction of a second
+    os.chdir(ROOT)
+    from ilp_model import load_fradir_inputs, get_initial_tolerances
+    import numpy as np
+    g, cut_srlgs, intensity, prob_matrix = load_fradir_inputs('usa_995')
+    step = prob_matrix.shape[0] // 60
+    intensity = np.asarray(intensity[:, ::step][:, :60])
+    prob_matrix = prob_matrix[::step][:60]
+    return g, cut_srlgs, intensity, prob_matrix, get_initial_tolerances(g, 6, 0)
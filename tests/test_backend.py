@@ -0,0 +1,62 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import backend
+from backend import (CandidateScoringPool, CriticalMagnitudeIndex, FallingApartEvaluator, LinkFailureBitsets,
+                     SparseIntensityMatrix, compile_network)
+
+
+def sparse(intensity, tolerance=6):
+    # the epicenters of every link that can exceed tolerance
+    stored = [np.flatnonzero(link.max(axis=-1) > tolerance) for link in intensity]
+    offsets = np.concatenate([[0], np.cumsum([len(p) for p in stored])])
+    values = np.concatenate([link[p] for link, p in zip(intensity, stored)])
+    return SparseIntensityMatrix(intensity.shape, offsets, np.concatenate(stored), values, tolerance)
+
+
+@pytest.fixture(scope='module')
+def memmap_subset(usa_995_subset, tmp_path_factory):
+    # the subset cube as a memory-mapped .npy file, like load_fradir_inputs gives it
+    g, cut_srlgs, intensity, prob_matrix, H = usa_995_subset
+    path = tmp_path_factory.mktemp('intensities') / 'intensity.npy'
+    np.save(path, intensity)
+    return np.load(path, mmap_mode='r')
+
+
+def test_shared_inputs(usa_995_subset, memmap_subset):
+    # what the candidate scoring workers get instead of the arrays: nothing large is pickled
+    intensity, prob_matrix = usa_995_subset[2:4]
+    shms = []
+    try:
+        assert isinstance(backend._share(memmap_subset, shms), backend._MappedArray)
+        assert isinstance(backend._share(memmap_subset[:, ::2], shms), backend._SharedArray)
+        assert isinstance(backend._share(prob_matrix, shms), backend._SharedArray)
+        for index in (CriticalMagnitudeIndex(intensity), LinkFailureBitsets(intensity), sparse(intensity)):
+            spec = backend._share(index, shms)
+            assert isinstance(spec, backend._SharedObject)
+            assert all(isinstance(array, backend._SharedArray) for array in spec.arrays.values())
+            assert len(pickle.dumps(spec)) < 2000
+            # the original keeps its arrays
+            assert all(isinstance(getattr(index, name), np.ndarray) for name in spec.arrays)
+        assert len(pickle.dumps(backend._share(memmap_subset, shms))) < 1000
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+def test_pool_matches_serial_scoring(usa_995_subset, memmap_subset):
+    g, cut_srlgs, intensity, prob_matrix, H = usa_995_subset
+    network = compile_network(g, cut_srlgs)
+    candidates = np.arange(len(network))
+    for intensity_matrix in (memmap_subset, CriticalMagnitudeIndex(intensity), sparse(intensity)):
+        evaluator = FallingApartEvaluator(cut_srlgs, network, intensity_matrix, H.copy(), prob_matrix)
+        serial = [evaluator.probability_after_upgrade(l) for l in candidates]
+        with CandidateScoringPool(2, cut_srlgs, network, intensity_matrix, prob_matrix, evaluator) as pool:
+            assert np.allclose(pool.probabilities_after_upgrade(candidates), serial)
+            # the workers see the upgrades applied in the parent
+            evaluator.apply(int(np.argmin(serial)))
+            serial = [evaluator.probability_after_upgrade(l) for l in candidates]
+            assert np.allclose(pool.probabilities_after_upgrade(candidates), serial)
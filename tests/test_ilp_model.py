@@ -0,0 +1,88 @@
+import numpy as np
+from mip import CBC, OptimizationStatus
+
+import ilp_model
+from ilp_model import HeuristicStart, build_fradir_model, sweep_TFA
+
+# the heuristics find the optimum of the subset at this TFA
+TFA = 0.00003
+
+
+def build(inputs, tmp_path, tfa=1.):
+    g, cut_srlgs, intensity, prob_matrix, H = inputs
+    model, deltaH, tfa_constr = build_fradir_model(g, cut_srlgs, intensity, prob_matrix, 6, 0, 3, tfa, CBC, str(tmp_path))
+    model.verbose = 0
+    return model, deltaH, tfa_constr
+
+
+def test_heuristic_start_at_the_optimum(usa_995_subset, tmp_path):
+    g, cut_srlgs, intensity, prob_matrix, H = usa_995_subset
+    model, deltaH, tfa_constr = build(usa_995_subset, tmp_path)
+    heuristic_start = HeuristicStart(model, deltaH, g, cut_srlgs, intensity, prob_matrix, H)
+    heuristic_cost, _ = heuristic_start.solution(TFA, tfa_constr)
+
+    cold, _ = sweep_TFA(*build(usa_995_subset, tmp_path), g, [TFA])
+    warm, upgrades = sweep_TFA(model, deltaH, tfa_constr, g, [TFA], heuristic_start=heuristic_start)
+    assert np.isclose(heuristic_cost, cold['Cost ILP'][0])
+    assert warm['Status'][0] == 'OPTIMAL'
+    assert np.isclose(warm['Cost ILP'][0], cold['Cost ILP'][0])
+    assert (upgrades['Delta H (ILP)'] >= 0).all()
+
+
+def test_start_discarded_by_the_cutoff(usa_995_subset, tmp_path, monkeypatch):
+    # a solver pruning everything down to the cutoff, the heuristic start included, finds the model infeasible
+    g, cut_srlgs, intensity, prob_matrix, H = usa_995_subset
+    model, deltaH, tfa_constr = build(usa_995_subset, tmp_path)
+    heuristic_start = HeuristicStart(model, deltaH, g, cut_srlgs, intensity, prob_matrix, H)
+    heuristic_cost, _ = heuristic_start.solution(TFA, tfa_constr)
+    solve_model = ilp_model.solve_model
+
+    def solve_below_cutoff(model, max_seconds):
+        model.cutoff = heuristic_cost - 1e-3
+        return solve_model(model, max_seconds)
+
+    monkeypatch.setattr(ilp_model, 'solve_model', solve_below_cutoff)
+    results, upgrades = sweep_TFA(model, deltaH, tfa_constr, g, [TFA], heuristic_start=heuristic_start)
+    assert results['Status'][0] == OptimizationStatus.OPTIMAL.name
+    assert np.isclose(results['Cost ILP'][0], heuristic_cost)
+    assert (upgrades['Delta H (ILP)'] >= 0).all()
+
+
+def test_time_to_solution_at_the_heuristic_cost(usa_995_subset, tmp_path):
+    # the cold solve finds a solution of exactly the heuristic cost, which an objective cutoff would discard
+    g, cut_srlgs, intensity, prob_matrix, H = usa_995_subset
+    model, deltaH, tfa_constr = build(usa_995_subset, tmp_path, TFA)
+    heuristic_cost, _ = HeuristicStart(model, deltaH, g, cut_srlgs, intensity, prob_matrix, H).solution(TFA, tfa_constr)
+    assert ilp_model.time_to_solution(lambda: build(usa_995_subset, tmp_path, TFA), heuristic_cost) >= 0
+    assert np.isnan(ilp_model.time_to_solution(lambda: build(usa_995_subset, tmp_path, TFA), heuristic_cost - 1))
+
+
+def test_heuristic_stops(usa_995_subset):
+    from backend import heuristic
+    g, cut_srlgs, intensity, prob_matrix, H = usa_995_subset
+    for version in (1, 2):
+        # a threshold no upgrade can meet
+        _, cost = heuristic(version, cut_srlgs, g, intensity, H.copy(), prob_matrix, -1.)
+        assert cost == np.inf
+        # a link past its highest tolerance
+        tolerance, cost = heuristic(version, cut_srlgs, g, intensity, H.copy(), prob_matrix, 0.000003, max_tolerance=H + 1)
+        assert cost == np.inf and (tolerance <= H + 1).all()
+        _, cost = heuristic(version, cut_srlgs, g, intensity, H.copy(), prob_matrix, 0.000003, max_tolerance=H + 3)
+        assert cost < np.inf
+
+
+def test_cold_sweep_clears_the_start(usa_995_subset, tmp_path):
+    g = usa_995_subset[0]
+    model, deltaH, tfa_constr = build(usa_995_subset, tmp_path)
+    warm, _ = sweep_TFA(model, deltaH, tfa_constr, g, [TFA])
+    model.start = [(v, 1.) for v in deltaH]
+    cold, _ = sweep_TFA(model, deltaH, tfa_constr, g, [TFA, 0.0001], warm_start=False)
+    assert model.start == []
+    assert np.isclose(cold['Cost ILP'][0], warm['Cost ILP'][0])
+
+
+def test_cached_model_lp_prewarms_the_cache(usa_995_subset, tmp_path):
+    g, cut_srlgs, intensity, prob_matrix, H = usa_995_subset
+    lp_file = ilp_model.cached_model_lp(g, cut_srlgs, intensity, prob_matrix, H, 3, 0.01, str(tmp_path))
+    build(usa_995_subset, tmp_path)
+    assert [str(p) for p in tmp_path.iterdir()] == [lp_file]
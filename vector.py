@@ -1,6 +1,7 @@
 import math
 from typing import List, Tuple
 
+import numpy as np
 from numpy import arccos, array, cross, dot, pi
 from numpy.linalg import det, norm
 
@@ -123,3 +124,41 @@ class Vector:
             return math.asin(member1 / member2)
         else:
             return min(self._great_circle_distance_to(v), self._great_circle_distance_to(w))
+
+
+# VECTORIZED SPHERE METHODS #
+
+# arrays of unit vectors are stored with the coordinates on the last axis: [..., 3]
+def _great_circle_distances(a, b):
+    return np.arccos(np.clip(np.einsum('...i,...i->...', a, b), -1., 1.))
+
+
+def great_circle_arc_distances(points, src, dst, chunk_size: int = 4096):
+    # batched Vector._distance_to_great_circle_arc: points [P,3], src/dst [L,3] -> [L,P]
+    points = np.asarray(points, dtype=float)
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    distances = np.empty((len(src), len(points)))
+
+    n1 = np.cross(src, dst)
+    n1_len = norm(n1, axis=-1)
+    len_arc = _great_circle_distances(src, dst)
+
+    for start in range(0, len(points), chunk_size):
+        u = points[start:start + chunk_size]
+        n2 = np.cross(n1[:, None, :], u[None, :, :])
+        c1 = np.cross(n1[:, None, :], n2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c1 = c1 / norm(c1, axis=-1, keepdims=True)
+            c2 = -c1
+
+            guess_c1 = np.abs(_great_circle_distances(c1, src[:, None, :]) + _great_circle_distances(c1, dst[:, None, :]) - len_arc[:, None])
+            guess_c2 = np.abs(_great_circle_distances(c2, src[:, None, :]) + _great_circle_distances(c2, dst[:, None, :]) - len_arc[:, None])
+            on_arc = np.fmin(guess_c1, guess_c2) < 0.0001
+
+            # perpendicular angular distance to great circle
+            perpendicular = np.arcsin(np.abs(u @ n1.T).T / n1_len[:, None])
+        endpoint = np.minimum(_great_circle_distances(u[None, :, :], src[:, None, :]),
+                              _great_circle_distances(u[None, :, :], dst[:, None, :]))
+        distances[:, start:start + chunk_size] = np.where(on_arc, perpendicular, endpoint)
+    return distances